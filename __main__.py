@@ -14,5 +14,10 @@
 # limitations under the License.
 
 
-import face
-face.start_face()
+import sys
+if len(sys.argv) > 1:
+    import cli
+    sys.exit(cli.main(sys.argv[1:]))
+else:
+    import face
+    face.start_face()
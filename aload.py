@@ -0,0 +1,348 @@
+# Copyright 2015 Serhiy Lysovenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Asynchronous loader: many transfers driven by one event loop
+"""
+
+import asyncio
+from http.client import parse_headers
+from io import BytesIO
+from threading import Thread, Lock
+from time import time
+import os.path as osp
+from urllib.error import HTTPError
+from urllib.parse import urlsplit, urljoin
+from load import DlQueue, TokenBucket, RateEstimator, format_rate, \
+    last_modified, limit_block, Checksum, content_total, verify_file, \
+    RetryPolicy, RETRY_ERRORS
+
+TIMEOUT = 60.
+REDIRECTS = 5
+
+
+class AsyncLoader:
+    """Has the same interface and status callback as load.Loader. It
+    connects to the hosts directly: the proxies set in the environment
+    are not used."""
+    def __init__(self, sstatus, workers=8, per_host=2, journal=None):
+        self.sstatus = sstatus
+        self.journal = journal
+        self.qlock = Lock()
+        self.queue = DlQueue()
+        self.loop = None
+        self.wake = None
+        self.workers = 8
+        self.per_host = 2
+        self.bucket = TokenBucket()
+        self.cap = 0.
+        self.verify = False
+        self.policy = RetryPolicy()
+        self.tries = {}
+        # (url, fname) of the items being loaded
+        self.active = set()
+        # (url, fname) -> error of the items given up
+        self.failed = {}
+        self.set_workers(workers)
+        self.set_per_host(per_host)
+
+    def add_file(self, url, fname, priority=0, journal=True):
+        """queue the item unless it is queued or being loaded already"""
+        if journal and self.journal is not None:
+            # see Loader.add_file
+            self.qlock.acquire()
+            fresh = (url, fname) not in self.active and \
+                self.queue.takes((url, fname), priority)
+            self.qlock.release()
+            if fresh:
+                self.journal.add(url, fname, priority)
+        self.qlock.acquire()
+        if (url, fname) not in self.active and \
+                self.queue.push(url, fname, priority):
+            self.failed.pop((url, fname), None)
+            self.sstatus(_("Queued"), fname)
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            t = Thread(target=self.t_loop, args=(self.loop,))
+            t.daemon = True
+            t.start()
+        else:
+            self.loop.call_soon_threadsafe(self.kick)
+        self.qlock.release()
+
+    def resume(self):
+        if self.journal is not None:
+            for url, fname, priority in self.journal.pending():
+                self.add_file(url, fname, priority, False)
+
+    def cancel(self, fname):
+        self.qlock.acquire()
+        res = self.queue.cancel(fname)
+        failed = [i for i in self.failed if i[1] == fname]
+        for key in failed:
+            del self.failed[key]
+        self.qlock.release()
+        for url, fname in res + failed:
+            self.tries.pop((url, fname), None)
+            if self.journal is not None:
+                self.journal.done(url, fname)
+            self.sstatus(None, fname)
+        return len(res)
+
+    def to_front(self, fname):
+        self.qlock.acquire()
+        res = self.queue.to_front(fname)
+        self.qlock.release()
+        return res
+
+    def set_workers(self, workers):
+        "set number of concurrent transfers"
+        try:
+            res = int(workers)
+        except (TypeError, ValueError):
+            res = 8
+        self.workers = min(max(res, 1), 256)
+
+    def set_per_host(self, per_host):
+        "set number of concurrent transfers from the same host"
+        try:
+            res = int(per_host)
+        except (TypeError, ValueError):
+            res = 2
+        self.per_host = min(max(res, 1), 16)
+
+    def set_rate(self, rate, cap=0):
+        self.bucket.set_rate(rate)
+        try:
+            self.cap = max(float(cap), 0.)
+        except (TypeError, ValueError):
+            self.cap = 0.
+
+    def set_verify(self, verify):
+        self.verify = bool(verify)
+
+    def set_retries(self, attempts):
+        self.policy.set_attempts(attempts)
+
+    def kick(self):
+        "wake up the dispatcher (called in the loop thread)"
+        if self.wake is not None:
+            self.wake.set()
+
+    def t_loop(self, loop):
+        "event loop thread"
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.dispatch())
+        finally:
+            loop.close()
+        self.sstatus(_("Done"))
+
+    async def dispatch(self):
+        """start transfers while there are free slots; items of the hosts
+        which have per_host transfers already wait in the queue and do not
+        take the slots"""
+        self.wake = asyncio.Event()
+        slots = asyncio.Semaphore(self.workers)
+        hosts = {}
+        tasks = set()
+        free = lambda key: hosts.get(
+            urlsplit(key[0]).netloc, 0) < self.per_host
+        while True:
+            await slots.acquire()
+            self.wake.clear()
+            uft = due = None
+            self.qlock.acquire()
+            if self.queue.ready():
+                try:
+                    uft = self.queue.pop(free)
+                except IndexError:
+                    # all ready items are of the busy hosts
+                    pass
+                else:
+                    self.active.add(uft)
+                    self.sstatus(_("%d in queue") % len(self.queue))
+            elif not tasks and not self.queue:
+                self.loop = None
+                self.qlock.release()
+                break
+            if uft is None:
+                due = self.queue.due()
+            self.qlock.release()
+            if uft is None:
+                slots.release()
+                # sleep until a deferred item is ready or a kick
+                try:
+                    await asyncio.wait_for(self.wake.wait(), None if due
+                                           is None else max(due - time(), 0))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            host = urlsplit(uft[0]).netloc
+            hosts[host] = hosts.get(host, 0) + 1
+            task = asyncio.ensure_future(self.load(uft, slots, hosts))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            task.add_done_callback(lambda t: self.kick())
+        self.wake = None
+
+    async def load(self, uft, slots, hosts):
+        "one transfer, hosts counts transfers per host"
+        host = urlsplit(uft[0]).netloc
+        wwp = lambda x, f=uft[1]: self.sstatus(x, f)
+        limits = (self.bucket, TokenBucket(self.cap))
+        tries = self.tries.pop(uft, None) or [0, None, Checksum()]
+        size = tries[2].size
+        try:
+            ra = await aload_file(uft[0], uft[1], wwp, limits, tries[2])
+            if ra:
+                if self.journal is not None:
+                    self.journal.progress(uft[0], uft[1], ra)
+                progress = tries[1] is None or ra < tries[1]
+                tries[1] = ra
+                self.retry(uft, tries, None, progress)
+                return
+            # the file is hashed again in the executor thread
+            err = await asyncio.get_running_loop().run_in_executor(
+                None, verify_file, uft[1], tries[2], self.verify)
+            if err is not None:
+                self.give_up(uft, err)
+                return
+            if self.journal is not None:
+                self.journal.done(uft[0], uft[1])
+            self.sstatus(None, uft[1])
+        except RETRY_ERRORS + (asyncio.TimeoutError,) as err:
+            self.retry(uft, tries, err, tries[2].size > size)
+        finally:
+            slots.release()
+            hosts[host] -= 1
+            if not hosts[host]:
+                del hosts[host]
+            # deferred item is in the queue already
+            self.qlock.acquire()
+            self.active.discard(uft)
+            self.qlock.release()
+
+    def give_up(self, uft, err):
+        self.qlock.acquire()
+        self.failed[uft] = str(err)
+        self.qlock.release()
+        self.sstatus(_("Error: {0}").format(err), uft[1])
+
+    def retry(self, uft, tries, err, progress):
+        "defer the failed item or give it up (called in the loop thread)"
+        wait = self.policy.next_try(tries, err, progress)
+        reason = _("incomplete") if err is None else err
+        if wait is None:
+            if self.journal is not None:
+                self.journal.done(uft[0], uft[1])
+            self.give_up(uft, reason)
+            return
+        self.qlock.acquire()
+        if self.queue.defer(uft[0], uft[1], time() + wait):
+            self.tries[uft] = tries
+        self.qlock.release()
+        self.sstatus(_("{0}, retry in {1:.0f} s").format(reason, wait),
+                     uft[1])
+        self.kick()
+
+
+async def request(url, res_len=0):
+    "send GET request and read response headers"
+    for i in range(REDIRECTS):
+        parts = urlsplit(url)
+        https = parts.scheme == "https"
+        port = parts.port or (443 if https else 80)
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(
+            parts.hostname, port, ssl=True if https else None), TIMEOUT)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        lines = ["GET %s HTTP/1.0" % path, "Host: %s" % parts.netloc,
+                 "User-Agent: Python-urllib", "Connection: close"]
+        if res_len > 0:
+            lines.append("Range: bytes=%d-" % res_len)
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), TIMEOUT)
+        sline, hlines = head.split(b"\r\n", 1)
+        status = int(sline.split()[1])
+        info = parse_headers(BytesIO(hlines))
+        if status in (301, 302, 303, 307, 308) and info.get("Location"):
+            writer.close()
+            url = urljoin(url, info.get("Location"))
+            continue
+        return url, status, info, reader, writer
+    writer.close()
+    raise HTTPError(url, status, "Too many redirects", info, None)
+
+
+async def aload_file(url, outfile, wwp, limits=(), check=None):
+    "asynchronous counterpart of load.load_file"
+    if osp.isfile(outfile):
+        res_len = osp.getsize(outfile)
+    else:
+        res_len = 0
+    wwp(_("Connecting..."))
+    lwt = time()
+    url, status, info, reader, writer = await request(url, res_len)
+    try:
+        if status == 416:
+            wwp(_("Nothing to do"))
+            return
+        if status >= 400:
+            raise HTTPError(url, status, "", info, None)
+        open_mode = "ab"
+        if status != 206:
+            open_mode = "wb"
+            res_len = 0
+        cont_len = int(info.get("Content-Length", 0))
+        m_time = last_modified(info)
+        if check is not None:
+            # the resumed part of the file is hashed in the executor
+            # thread, it may be long
+            await asyncio.get_running_loop().run_in_executor(
+                None, check.start, outfile, res_len)
+            check.total = content_total(info, res_len + cont_len)
+        written = 0
+        if cont_len == 0:
+            return
+        est = RateEstimator()
+        block_size = min(1024, cont_len)
+        with open(outfile, open_mode) as fo:
+            while written < cont_len:
+                block_size = limit_block(block_size, limits)
+                d_bl = await asyncio.wait_for(
+                    reader.read(block_size), TIMEOUT)
+                if len(d_bl) == 0:
+                    break
+                written += len(d_bl)
+                fo.write(d_bl)
+                if check is not None:
+                    check.update(d_bl)
+                wait = max([i.reserve(len(d_bl)) for i in limits] + [0.])
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                est.update(len(d_bl))
+                block_size = est.block_size(block_size)
+                after = time()
+                if after - lwt >= 1:
+                    wwp("%05.2f%% %s %sETA" %
+                        ((written + res_len) / (cont_len + res_len) * 100,
+                         format_rate(est.average()),
+                         est.eta(cont_len - written)))
+                    lwt = after
+    finally:
+        writer.close()
+    if m_time is not None:
+        osp.os.utime(outfile, (time(), m_time))
+    return cont_len - written
@@ -0,0 +1,181 @@
+# Copyright 2015 Serhiy Lysovenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+On-disk cache of fetched pages
+"""
+
+from collections import OrderedDict
+from hashlib import sha1
+import json
+import os
+import os.path as osp
+from threading import Lock, get_ident
+from time import time
+from urllib.request import Request
+from pool import urlopen
+
+TTL = 3600.
+MAX_SIZE = 64 * 1048576
+CHUNK = 16384
+
+
+def cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or osp.expanduser("~/.cache")
+    return osp.join(base, "jml", "pages")
+
+
+class PageCache:
+    """Bodies are stored in files named by SHA-1 of the URL. The index
+    keeps validators (ETag, Last-Modified), time of the last check and
+    size of the entries in the order of use. Fresh entries are returned
+    without a request, stale ones are revalidated by conditional GET.
+    The least recently used entries are dropped when the total size
+    exceeds max_size."""
+    def __init__(self, path=None, ttl=TTL, max_size=MAX_SIZE):
+        self.path = path or cache_dir()
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = Lock()
+        self.index = None
+        self.size = 0
+
+    def load(self):
+        "read index (clock must be held)"
+        self.index = OrderedDict()
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(osp.join(self.path, "index.json")) as fp:
+                for key, entry in json.load(fp):
+                    self.index[key] = entry
+        except (OSError, ValueError, TypeError):
+            pass
+        self.size = sum(i["size"] for i in self.index.values())
+
+    def save(self):
+        "write index (clock must be held)"
+        fname = osp.join(self.path, "index.json")
+        try:
+            with open(fname + ".tmp", "w") as fp:
+                json.dump(list(self.index.items()), fp)
+            os.replace(fname + ".tmp", fname)
+        except OSError:
+            pass
+
+    def lookup(self, key):
+        self.clock.acquire()
+        if self.index is None:
+            self.load()
+        entry = self.index.get(key)
+        if entry is not None:
+            self.index.move_to_end(key)
+            entry = dict(entry)
+        self.clock.release()
+        return entry
+
+    def read(self, key):
+        try:
+            with open(osp.join(self.path, key), "rb") as fp:
+                return fp.read()
+        except OSError:
+            return None
+
+    def fetch(self, url):
+        "returns body of the page"
+        return b"".join(self.stream(url))
+
+    def stream(self, url, chunk_size=CHUNK):
+        """Yields body of the page by chunks as they arrive. The body is
+        stored when it is read completely."""
+        key = sha1(url.encode("utf8")).hexdigest()
+        entry = self.lookup(key)
+        body = None
+        if entry is not None:
+            body = self.read(key)
+            if body is not None and time() - entry["time"] < self.ttl:
+                yield body
+                return
+        req = Request(url)
+        if body is not None:
+            if entry.get("etag"):
+                req.add_header("If-None-Match", entry["etag"])
+            if entry.get("modified"):
+                req.add_header("If-Modified-Since", entry["modified"])
+        resp = urlopen(req)
+        if resp.status == 304 and body is not None:
+            resp.read()
+            resp.close()
+            self.touch(key)
+            yield body
+            return
+        chunks = []
+        try:
+            for chunk in iter(lambda: resp.read(chunk_size), b""):
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            resp.close()
+        self.store(key, url, b"".join(chunks), resp.info())
+
+    def touch(self, key):
+        self.clock.acquire()
+        if key in self.index:
+            self.index[key]["time"] = time()
+            self.save()
+        self.clock.release()
+
+    def store(self, key, url, data, info):
+        if not (info.get("ETag") or info.get("Last-Modified") or self.ttl):
+            return
+        fname = osp.join(self.path, key)
+        tmp = "%s.%d.tmp" % (fname, get_ident())
+        try:
+            with open(tmp, "wb") as fp:
+                fp.write(data)
+            os.replace(tmp, fname)
+        except OSError:
+            return
+        self.clock.acquire()
+        old = self.index.pop(key, None)
+        if old is not None:
+            self.size -= old["size"]
+        self.index[key] = {"url": url, "etag": info.get("ETag"),
+                           "modified": info.get("Last-Modified"),
+                           "time": time(), "size": len(data)}
+        self.size += len(data)
+        while self.size > self.max_size and len(self.index) > 1:
+            okey, old = self.index.popitem(last=False)
+            self.size -= old["size"]
+            try:
+                os.remove(osp.join(self.path, okey))
+            except OSError:
+                pass
+        self.save()
+        self.clock.release()
+
+    def clear(self):
+        self.clock.acquire()
+        if self.index is None:
+            self.load()
+        for key in self.index:
+            try:
+                os.remove(osp.join(self.path, key))
+            except OSError:
+                pass
+        self.index.clear()
+        self.size = 0
+        self.save()
+        self.clock.release()
+
+
+PAGES = PageCache()
@@ -0,0 +1,141 @@
+# Copyright 2015 Serhiy Lysovenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Headless batch mode (tkinter is not imported)
+"""
+
+from argparse import ArgumentParser
+from os.path import join, isdir, basename
+from os import makedirs
+from time import sleep
+import sys
+from sithub import get_sites, web_search, get_datapage, parse_page, \
+    set_crawl, SEARCH_TIMEOUT
+from load import Loader
+from settings import install_gettext
+
+
+def parse_args(argv):
+    sites = [i[0] for i in get_sites()]
+    parser = ArgumentParser(prog="jml", description=_(
+        "Search sites and load files from the data pages without GUI"))
+    parser.add_argument("pages", nargs="*", metavar="PAGE", help=_(
+        "page URL or site:/page"))
+    parser.add_argument("-i", "--input", metavar="FILE", help=_(
+        "read pages from the file, one per line (\"-\" for stdin)"))
+    parser.add_argument("-s", "--search", metavar="TEXT", help=_(
+        "print found pages"))
+    parser.add_argument("--site", action="append", choices=sites, help=_(
+        "site to search in (may be repeated, default: all)"))
+    parser.add_argument("-l", "--load-found", action="store_true", help=_(
+        "load the found pages too"))
+    parser.add_argument("-d", "--dir", default=".", help=_(
+        "output directory"))
+    parser.add_argument("-w", "--workers", type=int, default=1, help=_(
+        "number of files loaded at once"))
+    parser.add_argument("-k", "--segments", type=int, default=1, help=_(
+        "number of connections per file"))
+    parser.add_argument("-r", "--rate", type=float, default=0, help=_(
+        "bandwidth limit, KiB/s"))
+    parser.add_argument("-v", "--verify", action="store_true", help=_(
+        "hash loaded files again to check them"))
+    parser.add_argument("--retries", type=int, default=5, help=_(
+        "attempts to load a file after errors"))
+    parser.add_argument("-c", "--cap", type=int, default=0, help=_(
+        "follow pagination until so many pages are found"))
+    parser.add_argument("-o", "--offline", action="store_true", help=_(
+        "search the pages fetched before too"))
+    parser.add_argument("-t", "--timeout", type=float,
+                        default=SEARCH_TIMEOUT, help=_("search timeout, s"))
+    parser.add_argument("-n", "--dry-run", action="store_true", help=_(
+        "only print files which would be loaded"))
+    return parser.parse_args(argv)
+
+
+def read_pages(args):
+    pages = list(args.pages)
+    if args.input:
+        fp = sys.stdin if args.input == "-" else open(args.input)
+        with fp:
+            for line in fp:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    pages.append(line)
+    return pages
+
+
+def show_status(msg, fname=None):
+    if msg is None:
+        return
+    if fname is None:
+        print(msg)
+    else:
+        print("%s\t%s" % (basename(fname), msg))
+
+
+def main(argv):
+    install_gettext()
+    args = parse_args(argv)
+    set_crawl(args.cap)
+    pages = []
+    for spec in read_pages(args):
+        try:
+            pages.append(parse_page(spec))
+        except (KeyError, ValueError):
+            print(_("Error: {0}").format(spec), file=sys.stderr)
+    if args.search:
+        where = set(args.site or [i[0] for i in get_sites()])
+        report = {}
+        found = web_search(args.search, where, args.timeout, report,
+                           offline=args.offline)
+        for site, (latency, err) in sorted(report.items()):
+            if err is not None:
+                print(_("Error: {0}").format("%s: %s" % (site, err)),
+                      file=sys.stderr)
+        for i in found:
+            print("%s:%s\t%s" % (i["site"], i["page"], i["title"].strip()))
+            if args.load_found:
+                pages.append((i["site"], i["page"]))
+    if not pages:
+        return 0
+    if not args.dry_run and not isdir(args.dir):
+        makedirs(args.dir)
+    loader = Loader(show_status, args.workers, args.segments)
+    loader.set_rate(args.rate * 1024)
+    loader.set_verify(args.verify)
+    loader.set_retries(args.retries)
+    errors = 0
+    for site, page in pages:
+        try:
+            items, info, ptype = get_datapage(site, page)
+        except Exception as err:
+            print(_("Error: {0}").format(err), file=sys.stderr)
+            errors += 1
+            continue
+        if ptype == "Catalog":
+            for i in items:
+                print("%s:%s\t%s" % (i["site"], i["page"],
+                                     i["title"].strip()))
+            continue
+        for url, fname in items:
+            if args.dry_run:
+                print("%s\t%s" % (url, fname))
+            else:
+                loader.add_file(url, join(args.dir, fname))
+    # deferred items stay in the queue while no worker is running
+    while loader.running or len(loader.queue):
+        sleep(0.5)
+    # files given up after the retries or failed the check
+    errors += len(loader.failed)
+    return 1 if errors else 0
@@ -97,29 +97,40 @@ class Dialog(Toplevel):
         pass
 
 
-class DlgDelay(Dialog):
+class DlgRate(Dialog):
     def body(self, master, cfg={}):
         "place user dialog widgets"
         self.config = cfg
         self.config["OK button"] = False
-        self.delay = StringVar()
-        self.delay.set(cfg.get("delay", ""))
-        self.edelay = Entry(master, width=15, textvariable=self.delay)
-        self.edelay.grid(column=1, row=0, sticky="e")
-        Label(master, text=_("Delay:")).grid(column=0, row=0, sticky="w")
+        self.rate = StringVar()
+        self.rate.set(cfg.get("rate", ""))
+        self.cap = StringVar()
+        self.cap.set(cfg.get("rate-cap", ""))
+        self.erate = Entry(master, width=15, textvariable=self.rate)
+        self.erate.grid(column=1, row=0, sticky="e")
+        Label(master, text=_("Total, KiB/s:")).grid(
+            column=0, row=0, sticky="w")
+        self.ecap = Entry(master, width=15, textvariable=self.cap)
+        self.ecap.grid(column=1, row=1, sticky="e")
+        Label(master, text=_("Per download, KiB/s:")).grid(
+            column=0, row=1, sticky="w")
+        Label(master, text=_("Zero means no limit")).grid(
+            column=0, row=2, columnspan=2, sticky="w")
         self.resizable(width=0, height=0)
-        return self.edelay
+        return self.erate
 
     def validate(self):
-        try:
-            flt = float(self.delay.get())
-        except ValueError:
-            return self.edelay
-        if flt < 0 or flt > 5:
-            return self.edelay
+        for var, entry in ((self.rate, self.erate), (self.cap, self.ecap)):
+            try:
+                flt = float(var.get())
+            except ValueError:
+                return entry
+            if flt < 0:
+                return entry
         return None
 
     def apply(self):
         "On ok button pressed"
-        self.config["delay"] = self.delay.get()
+        self.config["rate"] = float(self.rate.get())
+        self.config["rate-cap"] = float(self.cap.get())
         self.config["OK button"] = True
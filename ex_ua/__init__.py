@@ -15,38 +15,140 @@
 EX-UA data treatment
 """
 
-from urllib.request import urlopen, Request
-from urllib.parse import urlencode
-from .parser import SearchParser, parse_dpage, InfoParser, CatalogParser
+from codecs import getincrementaldecoder
+from concurrent.futures import ThreadPoolExecutor, Future, wait, \
+    FIRST_COMPLETED
+from threading import Lock
+from time import time, sleep
+from urllib.parse import urlencode, urlsplit
+from .parser import SearchParser, scan_dpage, InfoParser, feed_stream, \
+    page_numbers
 from hashlib import md5
+from cache import PAGES
+
+
+CRAWL = {"cap": 0, "workers": 4, "delay": 0.5}
+
+
+def set_crawl(cap=0, workers=4, delay=0.5):
+    """Follow pagination until cap pages are found (0 - only the first
+    page) with workers concurrent requests started at least delay
+    seconds apart."""
+    CRAWL["cap"] = max(int(cap), 0)
+    CRAWL["workers"] = max(int(workers), 1)
+    CRAWL["delay"] = max(float(delay), 0.)
+
+
+def add_hashes(found):
+    for i in found:
+        md5o = md5("/".join((i["site"], i["page"])).encode("utf8"))
+        i["hash"] = md5o.hexdigest()
+    return found
+
+
+def fetch_text(url):
+    decoder = getincrementaldecoder("utf-8")()
+    text = [decoder.decode(i) for i in PAGES.stream(url)]
+    text.append(decoder.decode(b"", True))
+    return "".join(text)
+
+
+def crawl(url, query, extract, first=None):
+    """Fetches pages of the pagination of url?query concurrently and
+    yields lists of the new items as the pages arrive. extract(text)
+    returns items of the page. If text of the first page is given,
+    only the rest ones are fetched."""
+    cap = CRAWL["cap"]
+    path = urlsplit(url).path
+    seen = set()
+    slock = Lock()
+    starts = [0.]
+
+    def fetch(num):
+        "wait for politeness delay and get the page"
+        slock.acquire()
+        wait = starts[0] - time()
+        starts[0] = max(starts[0], time()) + CRAWL["delay"]
+        slock.release()
+        if wait > 0:
+            sleep(wait)
+        pquery = list(query)
+        if num:
+            pquery.append(("p", num))
+        return fetch_text("%s?%s" % (url, urlencode(pquery)))
+
+    with ThreadPoolExecutor(CRAWL["workers"]) as executor:
+        numbers = {0}
+        futures = {}
+        if first is None:
+            futures[executor.submit(fetch, 0)] = 0
+        else:
+            ready = Future()
+            ready.set_result(first)
+            futures[ready] = 0
+        while futures and len(seen) < cap:
+            done, not_done = wait(futures, return_when=FIRST_COMPLETED)
+            for fut in done:
+                num = futures.pop(fut)
+                try:
+                    text = fut.result()
+                except (OSError, ValueError):
+                    if num == 0:
+                        raise
+                    continue
+                new = []
+                for i in extract(text):
+                    if i["page"] not in seen and len(seen) < cap:
+                        seen.add(i["page"])
+                        new.append(i)
+                if new:
+                    yield add_hashes(new)
+                for nxt in sorted(page_numbers(text, path) - numbers):
+                    numbers.add(nxt)
+                    futures[executor.submit(fetch, nxt)] = nxt
+        for fut in futures:
+            fut.cancel()
+
+
+def iter_search(what):
+    "yields lists of found pages as soon as they are parsed"
+    query = [("s", what), ("per", 100)]
+    if CRAWL["cap"]:
+        for found in crawl("http://ex.ua/search", query,
+                           lambda text: SearchParser(text).found):
+            yield found
+        return
+    sp = SearchParser()
+    for found in feed_stream(sp, PAGES.stream(
+            "http://ex.ua/search?%s" % urlencode(query))):
+        yield add_hashes(found)
 
 
 def web_search(what):
-    o = urlopen("http://ex.ua/search?%s" %
-                urlencode([("s", what), ("per", 100)]))
-    sp = SearchParser(o.read().decode())
-    del o
-    if sp.found:
-        for i in sp.found:
-            md5o = md5("/".join((i["site"], i["page"])).encode("utf8"))
-            i["hash"] = md5o.hexdigest()
-        return list(sp.found)
-    return []
-
-
-def get_datapage(page):
-    r = Request("http://www.ex.ua" + page)
-    o = urlopen(r)
-    html_text = o.read().decode()
-    o.close()
-    files, info = parse_dpage(html_text)
+    result = []
+    for found in iter_search(what):
+        result += found
+    return result
+
+
+def get_datapage(page, found=None):
+    """If crawling is on, the rest pages of the catalog are loaded too and
+    passed to found() as they arrive. The page itself is not parsed while
+    it arrives: whether it is a file or a catalog page is known only from
+    the whole text, and scan_dpage of the whole page costs less than
+    feeding CatalogParser (see ex_ua.bench)."""
+    text = fetch_text("http://www.ex.ua" + page)
+    files, info, items = scan_dpage(text)
     if info:
         info = InfoParser(info).text
     if files:
         return files, info, "Files"
-    cat_par = CatalogParser(html_text)
-    found = list(cat_par.found)
-    for i in found:
-            md5o = md5("/".join((i["site"], i["page"])).encode("utf8"))
-            i["hash"] = md5o.hexdigest()
-    return found, list(cat_par.text), "Catalog"
+    items = add_hashes(items)
+    if CRAWL["cap"]:
+        url = "http://www.ex.ua" + page.split("?", 1)[0]
+        items = []
+        for part in crawl(url, [], lambda t: scan_dpage(t)[2], text):
+            items += part
+            if found is not None:
+                found(part)
+    return items, info or [], "Catalog"
@@ -0,0 +1,108 @@
+# Copyright 2015 Serhiy Lysovenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmark of the data page parsing against saved pages:
+
+    python3 -m ex_ua.bench page.html [page.html ...]
+
+Without arguments the saved pages of tests/data and synthetic pages
+with many files and links are used.
+"""
+
+from ast import literal_eval
+from glob import glob
+import os.path as osp
+from sys import argv
+from timeit import repeat
+from .parser import scan_dpage, CatalogParser, _MEDIA_TYPES
+
+
+def legacy_parse(text):
+    "previous implementation: split into rows, then HTMLParser pass"
+    res = []
+    pos = text.find("player_list")
+    if pos >= 0:
+        st = text.find("'", pos) + 1
+        arr = literal_eval("[" + text[st:text.find("'", st)] + "]")
+        for row in text.split("<tr>"):
+            if "play_index(" in row and "title=" in row:
+                tp = row.find("title=") + 7
+                fname = row[tp:row.find("'", tp)]
+                fname = fname[:fname.rfind(".")]
+                tp = row.find("play_index(") + 11
+                try:
+                    i = arr[int(row[tp:row.find(")", tp)])]
+                except (ValueError, IndexError):
+                    continue
+                fname = fname.replace("&#39;", "'").replace("&amp;", "&")
+                fname += "." + _MEDIA_TYPES.get(i["type"], i["type"])
+                res.append((i["url"], fname))
+    st = text.find("<td valign=top>")
+    info = None
+    if st > 0:
+        st += 15
+        info = text[st:text.find("</td>", st)]
+    if res:
+        return res, info, []
+    return res, info, CatalogParser(text).found
+
+
+def synthetic_page(nfiles=3000, nlinks=3000):
+    plist = ",".join('{"url": "/get/%d", "type": "video"}' % i
+                     for i in range(nfiles))
+    rows = "".join("<tr><td><a href='/get/%d' title='file &amp; %d.avi'>"
+                   "file</a></td><td><a onclick='play_index(%d)'>play</a>"
+                   "</td></tr>\n" % (i, i, i) for i in range(nfiles))
+    links = "".join('<tr><td><a href="/%d?r=1"><b>Item</b> %d</a></td></tr>'
+                    % (i, i) for i in range(nlinks))
+    return ("<html><script>player_list = '%s';</script><table>%s</table>"
+            "<td valign=top><h1>Title</h1><p>Text</td>"
+            "<table class=include_0>%s</table></html>" % (plist, rows, links))
+
+
+def same_results(text):
+    "scan_dpage finds the same as the previous implementation"
+    new = scan_dpage(text)
+    old = legacy_parse(text)
+    return new[0] == old[0] and new[1] == old[1] and \
+        bool(new[0] or new[2] == old[2])
+
+
+def bench(name, text, number=5):
+    new = scan_dpage(text)
+    same = same_results(text)
+    tnew = min(repeat(lambda: scan_dpage(text), number=number, repeat=3))
+    told = min(repeat(lambda: legacy_parse(text), number=number, repeat=3))
+    print("%s: %d KiB, %d files, %d links, legacy %.2f ms, scan %.2f ms, "
+          "x%.1f%s" % (name, len(text) // 1024, len(new[0]), len(new[2]),
+                       told / number * 1e3, tnew / number * 1e3,
+                       told / tnew, "" if same else ", RESULTS DIFFER"))
+
+
+FIXTURES = osp.join(osp.dirname(osp.dirname(osp.abspath(__file__))),
+                    "tests", "data", "ex_ua_*.html")
+
+
+def main(paths):
+    if not paths:
+        paths = sorted(glob(FIXTURES))
+        bench("synthetic files", synthetic_page(nlinks=0))
+        bench("synthetic catalog", synthetic_page(nfiles=0))
+    for path in paths:
+        with open(path, encoding="utf-8", errors="replace") as fp:
+            bench(path, fp.read())
+
+
+if __name__ == "__main__":
+    main(argv[1:])
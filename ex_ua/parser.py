@@ -11,23 +11,45 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from ast import literal_eval
+from codecs import getincrementaldecoder
+from html import unescape
 from html.parser import HTMLParser
+import json
 from sys import hexversion
+from urllib.parse import urlsplit, parse_qs
+
+
+def feed_stream(parser, chunks, encoding="utf-8"):
+    """Feeds parser by chunks of bytes decoded incrementally and yields
+    lists of items found in every chunk."""
+    decoder = getincrementaldecoder(encoding)()
+    sent = 0
+    for chunk in chunks:
+        parser.feed(decoder.decode(chunk))
+        if len(parser.found) > sent:
+            yield parser.found[sent:]
+            sent = len(parser.found)
+    parser.feed(decoder.decode(b"", True))
+    parser.close()
+    if len(parser.found) > sent:
+        yield parser.found[sent:]
 
 
 class SearchParser(HTMLParser):
-    "parses  html file"
-    def __init__(self, data):
+    "parses  html file (data may be fed later)"
+    def __init__(self, data=None):
         di = {}
-        if hexversion >= 0x030200f0:
+        if 0x030200f0 <= hexversion < 0x030500f0:
             di["strict"] = False
         HTMLParser.__init__(self, **di)
         self.found = []
         self.is_topen = False
         self.is_aopen = False
         self.curdata = {}
-        self.feed(data)
-        self.close()
+        if data is not None:
+            self.feed(data)
+            self.close()
 
     def handle_starttag(self, tag, attrs):
         dattrs = dict(attrs)
@@ -62,10 +84,10 @@ class SearchParser(HTMLParser):
 
 
 class CatalogParser(HTMLParser):
-    "parses  Ex-ua catalog"
-    def __init__(self, data):
+    "parses  Ex-ua catalog (data may be fed later)"
+    def __init__(self, data=None):
         di = {}
-        if hexversion >= 0x030200f0:
+        if 0x030200f0 <= hexversion < 0x030500f0:
             di["strict"] = False
         HTMLParser.__init__(self, **di)
         self.text = []
@@ -75,8 +97,9 @@ class CatalogParser(HTMLParser):
         self.is_aopen = False
         self.parse_info = False
         self.curdata = {}
-        self.feed(data)
-        self.close()
+        if data is not None:
+            self.feed(data)
+            self.close()
 
     def handle_starttag(self, tag, attrs):
         dattrs = dict(attrs)
@@ -129,50 +152,170 @@ class CatalogParser(HTMLParser):
 _MEDIA_TYPES = {"video": "flv", "audio": "mp3"}
 
 
-def parse_dpage(text):
+def parse_player_list(text):
+    "parse JavaScript array of the player without eval"
+    try:
+        return json.loads("[" + text + "]")
+    except ValueError:
+        pass
+    try:
+        return literal_eval("[" + text + "]")
+    except (ValueError, SyntaxError):
+        return []
+
+
+def scan_dpage(text):
+    """Scans the data page with str.find: one forward walk per kind of
+    marker (player_list, play_index rows, info block, include_0 tables)
+    without splitting the page into rows or building a DOM. Returns list
+    of (url, fname) of the player files, HTML of the info block (or
+    None) and list of the catalog links."""
+    files = []
+    rows = []
+    arr = []
     pos = text.find("player_list")
-    if pos < 0:
-        return None, None
-    st = text.find("'", pos)
-    if st < 0:
-        return None, None
-    st += 1
-    en = text.find("'", st)
-    arr = eval("["+text[st:en]+"]")
-    res = []
-    for row in text.split("<tr>"):
-        if "play_index(" in row and "title=" in row:
-            tp = row.find("title=")
-            tp += 7
-            te = row.find("'", tp)
-            fname = row[tp:te]
-            fname = fname[:fname.rfind(".")]
-            tp = row.find("play_index(")
-            tp += 11
-            te = row.find(")", tp)
-            try:
-                ind = int(row[tp:te])
-            except:
-                continue
-            fname = fname.replace("&#39;", "'").replace("&amp;", "&")
-            i = arr[ind]
-            fname += "." + _MEDIA_TYPES.get(i["type"], i["type"])
-            res.append((i["url"], fname))
+    if pos >= 0:
+        st = text.find("'", pos) + 1
+        if st > 0:
+            en = text.find("'", st)
+            arr = parse_player_list(text[st:en])
+    row_end = 0
+    pos = text.find("play_index(")
+    while pos >= 0:
+        if pos >= row_end:
+            row_st = max(text.rfind("<tr>", row_end, pos), 0)
+            row_end = text.find("<tr>", pos)
+            if row_end < 0:
+                row_end = len(text)
+            rows.append((row_st, pos, row_end))
+        pos = text.find("play_index(", pos + 11)
+    for row_st, pos, row_end in rows:
+        tp = text.find("title=", row_st, row_end)
+        if tp < 0:
+            continue
+        tp += 7
+        te = text.find("'", tp, row_end)
+        fname = text[tp:te]
+        fname = fname[:fname.rfind(".")]
+        tp = pos + 11
+        te = text.find(")", tp, row_end)
+        try:
+            i = arr[int(text[tp:te])]
+        except (ValueError, IndexError):
+            continue
+        fname = fname.replace("&#39;", "'").replace("&amp;", "&")
+        fname += "." + _MEDIA_TYPES.get(i["type"], i["type"])
+        files.append((i["url"], fname))
+    info = None
     st = text.find("<td valign=top>")
     if st > 0:
         st += 15
-        en = text.find("</td>", st)
-        info = text[st:en]
-    else:
-        info = None
-    return res, info
+        info = text[st:text.find("</td>", st)]
+    links = []
+    pos = text.find("include_0")
+    while pos >= 0:
+        tst = text.rfind("<table", 0, pos)
+        tend = text.find("</table>", pos)
+        if tend < 0:
+            tend = len(text)
+        if tst >= 0 and "class" in text[tst:pos]:
+            links += scan_links(text, tst, tend)
+        pos = text.find("include_0", tend)
+    return files, info, links
+
+
+def scan_links(text, start, end):
+    "catalog links of the table cells like CatalogParser finds them"
+    found = []
+    td = text.find("<td", start, end)
+    while td >= 0:
+        tde = text.find("</td>", td, end)
+        if tde < 0:
+            tde = end
+        curdata = {}
+        a = text.find("<a ", td, tde)
+        while a >= 0:
+            ae = text.find(">", a, tde)
+            if ae < 0:
+                break
+            ac = text.find("</a>", ae, tde)
+            if ac < 0:
+                ac = tde
+            href = tag_attr(text[a:ae], "href")
+            if "?" in href:
+                href = href[:href.find("?")]
+            if href.startswith("/") and href[1:].isdigit():
+                curdata["page"] = href
+                curdata["site"] = "ex-ua"
+                curdata["title"] = curdata.get("title", "") + \
+                    strip_tags(text[ae + 1:ac])
+            a = text.find("<a ", ac, tde)
+        if curdata:
+            if not curdata["title"]:
+                curdata["title"] = "No title"
+            found.append(curdata)
+        td = text.find("<td", tde, end)
+    return found
+
+
+def tag_attr(tag, name):
+    "value of the attribute in the start tag or empty string"
+    pos = tag.find(name + "=")
+    if pos < 0:
+        return ""
+    pos += len(name) + 1
+    if tag[pos:pos + 1] in ("'", '"'):
+        end = tag.find(tag[pos], pos + 1)
+        return unescape(tag[pos + 1:end if end >= 0 else len(tag)])
+    end = pos
+    while end < len(tag) and not tag[end].isspace():
+        end += 1
+    return unescape(tag[pos:end])
+
+
+def page_numbers(text, path):
+    "numbers of the pages linked by the pagination of the path"
+    res = set()
+    pos = text.find("<a ")
+    while pos >= 0:
+        end = text.find(">", pos)
+        if end < 0:
+            break
+        parts = urlsplit(tag_attr(text[pos:end], "href"))
+        if parts.path == path:
+            for i in parse_qs(parts.query).get("p", ()):
+                if i.isdigit():
+                    res.add(int(i))
+        pos = text.find("<a ", end)
+    return res
+
+
+def strip_tags(html):
+    res = []
+    pos = 0
+    while True:
+        lt = html.find("<", pos)
+        if lt < 0:
+            res.append(html[pos:])
+            break
+        res.append(html[pos:lt])
+        pos = html.find(">", lt)
+        if pos < 0:
+            break
+        pos += 1
+    return unescape("".join(res))
+
+
+def parse_dpage(text):
+    files, info, links = scan_dpage(text)
+    return files, info
 
 
 class InfoParser(HTMLParser):
     "parses  html file"
     def __init__(self, data):
         di = {}
-        if hexversion >= 0x030200f0:
+        if 0x030200f0 <= hexversion < 0x030500f0:
             di["strict"] = False
         HTMLParser.__init__(self, **di)
         self.text = []
@@ -18,13 +18,23 @@ Making a face of the application
 from tkinter import Tk, Menu, PhotoImage, ttk, Text, StringVar, messagebox, \
     BooleanVar
 from tkinter.filedialog import askdirectory
-from os.path import isdir, join, dirname
+from os.path import isdir, join, dirname, expanduser, basename
 from os import makedirs
-from threading import Lock
-from sithub import get_sites, web_search, get_datapage
+from queue import Queue, Empty
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from sithub import get_sites, web_search, get_datapage, set_crawl, \
+    SEARCH_TIMEOUT
 from load import Loader
-from settings import Config
-from dialogs import DlgDelay
+from aload import AsyncLoader
+from journal import Journal
+from cache import PAGES
+from textindex import INDEX
+from settings import Config, install_gettext
+from dialogs import DlgRate
+
+# tree rows inserted between two idle callbacks
+TREE_CHUNK = 200
 
 
 def autoscroll(sbar, first, last):
@@ -44,39 +54,76 @@ class Face:
         self.root = root
         root.grid_columnconfigure(0, weight=1)
         root.grid_rowconfigure(1, weight=1)
-        self.ufid = []
+        # file nodes: tree id -> (url, fname, page id)
+        self.files = {}
         self.cfg = Config()
+        set_crawl(self.cfg.setdefault("crawl-cap", 0),
+                  self.cfg.setdefault("crawl-workers", 4),
+                  self.cfg.setdefault("crawl-delay", 0.5))
+        PAGES.ttl = self.cfg.setdefault("cache-ttl", PAGES.ttl)
+        PAGES.max_size = self.cfg.setdefault(
+            "cache-size", PAGES.max_size // 1048576) * 1048576
         root.geometry(self.cfg.get("geometry"))
         self.add_control(root)
         pw = ttk.Panedwindow(root, orient="vertical")
         self.pw = pw
         pw.add(self.make_tree())
         pw.add(self.make_text_field())
+        pw.add(self.make_downloads())
         pw.grid(column=0, row=1, columnspan=2, sticky="senw")
         self.pw.sashpos(0, self.cfg.get("sashpos"))
+        self.pw.sashpos(1, self.cfg.get("sashpos1"))
         self.sz = ttk.Sizegrip(root)
         self.sz.grid(column=1, row=2, sticky="se")
         self.status = StringVar()
         st_lab = ttk.Label(root, textvariable=self.status)
         st_lab.grid(column=0, row=2, sticky="we")
+        self.events = Queue()
+        self.drain_status()
         self.add_menu()
         self.locked = False
-        self.loader = Loader(self.sstatus)
-        self.slock = Lock()
+        self.loader = self.make_loader()
+        self.set_rate()
+        self.loader.set_verify(self.cfg.setdefault("verify", False))
+        self.loader.set_retries(self.cfg.setdefault("retries", 5))
+        self.loader.resume()
         self.pages = {}
-        self.do_remember()
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.pfexecutor = ThreadPoolExecutor(max_workers=2)
+        # page hash -> result of get_datapage or its future while
+        # loading, oldest first
+        self.prefetched = OrderedDict()
+        self.pfgen = 0
+        self.busy = 0
+        self.search_gen = 0
+        self.search_fut = None
+        # bookmarks are read when the window is shown
+        self.remember = {}
+        root.after_idle(self.do_remember)
         root.tk.call("wm", "iconphoto", root._w,
                      PhotoImage(file=join(dirname(__file__), "icon.gif")))
 
+    def make_loader(self):
+        cfg = self.cfg
+        journal = Journal(expanduser("~/.jml-queue"))
+        if cfg.setdefault("engine", "threads") == "async":
+            return AsyncLoader(self.sstatus,
+                               cfg.setdefault("async-workers", 8),
+                               cfg.setdefault("per-host", 2), journal)
+        return Loader(self.sstatus, cfg.setdefault("workers", 1),
+                      cfg.setdefault("segments", 1), journal)
+
     def do_remember(self):
-        self.remember = self.cfg.get("remembered", {})
+        self.remember = self.cfg.bookmarks
+        rows = []
         for i, d in self.remember.items():
             self.pages[i] = {"entered": False}
             tags = ("page", "bmk")
             self.pages[i].update(d)
             if "folder" in d and d["folder"] is not None:
                 tags += ("folder",)
-            self.tree.insert("", "end", i, text=d["title"], tags=tags)
+            rows.append((i, d["title"], tags))
+        self.insert_rows("", rows, self.pages)
 
     def add_control(self, frame):
         self.control = ttk.Frame(frame)
@@ -87,6 +134,10 @@ class Face:
         self.btn.grid(column=0, row=0, sticky="w")
         self.entry = ttk.Entry(self.control, width=60)
         self.entry.grid(column=1, row=0, sticky="ew", padx=3)
+        self.progress = ttk.Progressbar(self.control, mode="indeterminate",
+                                        length=60)
+        self.progress.grid(column=2, row=0, sticky="e")
+        self.progress.grid_remove()
         self.entry.bind("<KeyPress-Return>", self.search)
         self.dirname = StringVar()
         self.dirname.set(self.cfg.get("last-dir", ""))
@@ -116,6 +167,7 @@ class Face:
         tree.tag_bind("page", "<Insert>", self.remember_pg)
         tree.tag_bind("file", "<Return>", self.enter_file)
         tree.tag_bind("file", "<Double-Button-1>", self.enter_file)
+        tree.bind("<<TreeviewOpen>>", self.open_page)
         tree.tag_configure("page", background="gray")
         tree.tag_configure("file", foreground="blue", font="Monospace 12")
         tree.tag_configure("bmk", foreground="red")
@@ -137,6 +189,22 @@ class Face:
         text.tag_configure("h1", font="Times 16 bold", relief="raised")
         return frame
 
+    def make_downloads(self):
+        frame = ttk.Frame(self.pw)
+        frame.grid_columnconfigure(0, weight=1)
+        frame.grid_rowconfigure(0, weight=1)
+        self.dltree = dltree = ttk.Treeview(
+            frame, columns=("progress",), selectmode="extended", height=4)
+        dltree.heading("#0", text=_("File"))
+        dltree.heading("progress", text=_("Progress"))
+        dltree.grid(column=0, row=0, sticky="nwes")
+        vsb = ttk.Scrollbar(frame, command=dltree.yview, orient="vertical")
+        vsb.grid(column=1, row=0, sticky="ns")
+        dltree["yscrollcommand"] = lambda f, l: autoscroll(vsb, f, l)
+        dltree.bind("<Delete>", self.cancel_download)
+        dltree.bind("<Home>", self.download_first)
+        return frame
+
     def add_menu(self):
         top = self.tree.winfo_toplevel()
         top["menu"] = self.menubar = Menu(top)
@@ -154,34 +222,132 @@ class Face:
                                accelerator="Ctrl+Q", underline=1)
         self.root.bind_all("<Control-q>", lambda x: self.on_delete())
         self.medit.add_command(label=_("Clear"), command=self.clear_list)
-        self.medit.add_command(label=_("Delay..."), command=self.ask_delay)
+        self.medit.add_command(label=_("Clear cache"), command=PAGES.clear)
+        self.medit.add_command(label=_("Clear index"), command=INDEX.clear)
+        self.medit.add_command(label=_("Bandwidth..."), command=self.ask_rate)
         sel_sites = self.cfg.get("sites", set())
         self.sites = [i + (BooleanVar(),) for i in get_sites()]
         for site, name, bvar in self.sites:
             bvar.set(site in sel_sites)
             self.msites.add_checkbutton(
                 label=name, onvalue=True, offvalue=False, variable=bvar)
+        self.offline = BooleanVar()
+        self.offline.set(self.cfg.get("offline-search", False))
+        self.msites.add_separator()
+        self.msites.add_checkbutton(
+            label=_("Offline search"), onvalue=True, offvalue=False,
+            variable=self.offline)
+
+    def run_bg(self, callback, func, *args):
+        """Call func(*args) in the background thread. When it is done,
+        callback(result, error) is called in the Tk thread."""
+        fut = self.executor.submit(func, *args)
+        self.wait_bg(fut, callback)
+        return fut
+
+    def wait_bg(self, fut, callback):
+        """When the future is done, callback(result, error) is called in
+        the Tk thread."""
+        self.busy += 1
+        self.progress.grid()
+        self.progress.start()
+        self.root.after(50, self.poll_bg, fut, callback)
+
+    def poll_bg(self, fut, callback):
+        if not fut.done():
+            self.root.after(50, self.poll_bg, fut, callback)
+            return
+        self.busy -= 1
+        if not self.busy:
+            self.progress.stop()
+            self.progress.grid_remove()
+        if fut.cancelled():
+            return
+        try:
+            res = fut.result()
+        except Exception as err:
+            callback(None, err)
+        else:
+            callback(res, None)
 
     def search(self, evt=None):
         self.sstatus(_("Wait..."))
-        sr = web_search(
-            self.entry.get(), {i[0] for i in self.sites if i[2].get()})
+        if self.search_fut is not None:
+            self.search_fut.cancel()
+        self.search_gen += 1
+        report = {}
+        parts = Queue()
+        self.search_fut = self.run_bg(
+            lambda res, err, gen=self.search_gen:
+            self.found(res, err, report, gen),
+            web_search, self.entry.get(),
+            {i[0] for i in self.sites if i[2].get()},
+            self.cfg.setdefault("search-timeout", SEARCH_TIMEOUT), report,
+            parts.put, self.offline.get())
+        self.poll_found(parts, self.search_fut, "", self.search_gen)
+
+    def poll_found(self, parts, fut, where="", gen=None):
+        "insert the pages found so far while the request is running"
+        if gen is not None and gen != self.search_gen:
+            return
+        if where and where not in self.pages:
+            return
+        try:
+            while True:
+                self.insert_pages(parts.get_nowait(), where)
+        except Empty:
+            pass
+        if not fut.done():
+            self.root.after(100, self.poll_found, parts, fut, where, gen)
+
+    def found(self, sr, err, report, gen):
+        if gen != self.search_gen:
+            # superseded by the newer search
+            return
+        self.search_fut = None
+        if err is not None:
+            self.sstatus(_("Error: {0}").format(err))
+            return
         if sr is None:
             return
         self.insert_pages(sr)
+        errors = ["%s: %s" % (i, e) for i, (l, e) in sorted(report.items())
+                  if e is not None]
+        if errors:
+            self.sstatus(_("Error: {0}").format("; ".join(errors)))
 
     def insert_pages(self, pages, where=""):
         spages = self.pages
+        rows = []
         for i in pages:
             h = i["hash"]
             if h not in spages:
-                self.tree.insert(where, "end", h, text=i["title"],
-                                 tags=("page",))
+                rows.append((h, i["title"], ("page",)))
                 spages[h] = {"entered": False}
                 spages[h]["site"] = i["site"]
                 spages[h]["page"] = i["page"]
+        self.insert_rows(where, rows, spages)
         self.sstatus(_("OK"))
 
+    def insert_rows(self, where, rows, live):
+        """Insert rows (iid, text, tags) by chunks of TREE_CHUNK in idle
+        callbacks, so the window is repainted in between. The rows which
+        iid is no longer in live are skipped."""
+        self.root.after_idle(self.insert_chunk, where, iter(rows), live)
+
+    def insert_chunk(self, where, rows, live):
+        tree = self.tree
+        if where and not tree.exists(where):
+            return
+        n = 0
+        for iid, text, tags in rows:
+            if iid in live and not tree.exists(iid):
+                tree.insert(where, "end", iid, text=text, tags=tags)
+            n += 1
+            if n == TREE_CHUNK:
+                self.root.after_idle(self.insert_chunk, where, rows, live)
+                return
+
     def remember_pg(self, evt=None):
         """Switch page remember"""
         iid = self.tree.focus()
@@ -199,10 +365,11 @@ class Face:
             self.remember[iid] = remember
 
     def clear_list(self, evt=None):
-        for i in self.pages:
-            self.tree.delete(i)
+        self.tree.delete(*self.tree.get_children())
         self.pages.clear()
-        del self.ufid[:]
+        self.files.clear()
+        self.prefetched.clear()
+        self.pfgen += 1
         self.do_remember()
 
     def ask_dir(self, evt=None):
@@ -225,15 +392,28 @@ class Face:
                     return
                 makedirs(dname)
             if text is not None:
-                self.remember[curinfo]["folder"] = dname
+                curem = dict(curem)
+                curem["folder"] = dname
+                # assignment saves the bookmark
+                self.remember[curinfo] = curem
             else:
                 self.dirname.set(dname)
+                self.cfg["last-dir"] = dname
+                self.cfg.save()
 
-    def ask_delay(self, evt=None):
-        cfg = {"delay": "0"}
-        DlgDelay(self.root, _("Delay time"), cfg=cfg)
+    def ask_rate(self, evt=None):
+        cfg = {"rate": self.cfg.get("rate", 0),
+               "rate-cap": self.cfg.get("rate-cap", 0)}
+        DlgRate(self.root, _("Bandwidth limit"), cfg=cfg)
         if cfg["OK button"]:
-            self.loader.set_delay(cfg["delay"])
+            self.cfg["rate"] = cfg["rate"]
+            self.cfg["rate-cap"] = cfg["rate-cap"]
+            self.set_rate()
+
+    def set_rate(self):
+        "limits are stored in KiB/s"
+        self.loader.set_rate(self.cfg.get("rate", 0) * 1024,
+                             self.cfg.get("rate-cap", 0) * 1024)
 
     def del_page(self, evt=None):
         if type(evt) == str:
@@ -255,52 +435,130 @@ class Face:
             self.tree.selection_add(next_focus)
         self.remember.pop(iid, None)
         page = self.pages.pop(iid)
-        if "contains" in page:
-            i = 0
-            ufids = self.ufid
-            while i < len(ufids):
-                if ufids[i][3] == iid:
-                    ufids.pop(i)
-                else:
-                    i += 1
+        for tid in page.get("contains", ()):
+            self.files.pop(tid, None)
 
     def enter_page(self, evt=None):
-        self.sstatus(_("Wait..."))
         iid = self.tree.focus()
-        if not self.pages[iid]["entered"]:
-            self.pages[iid]["entered"] = True
-            try:
-                items, info, ptype = get_datapage(
-                    self.pages[iid]["site"], self.pages[iid]["page"])
-            except Exception as err:
-                self.sstatus(_("Error: {0}").format(err))
-                return
-            if ptype == "Files":
-                self.deflate_datapage(items, info, iid)
-            if ptype == "Catalog":
-                self.insert_pages(items, iid)
-                if info:
-                    self.pages[iid]["info"] = info
-                    self.text_info(iid)
+        page = self.pages[iid]
+        pre = None
+        if not page["entered"] and iid in self.prefetched:
+            pre = self.prefetched.pop(iid)
+            # prefetch which has not started yet is not waited for
+            if isinstance(pre, Future) and pre.cancel():
+                pre = None
+        if isinstance(pre, Future):
+            self.sstatus(_("Wait..."))
+            page["entered"] = True
+            self.wait_bg(pre, lambda res, err: self.page_entered(
+                iid, page, res, err))
+        elif pre is not None:
+            page["entered"] = True
+            self.page_entered(iid, page, pre, None)
+        elif not page["entered"]:
+            self.sstatus(_("Wait..."))
+            page["entered"] = True
+            parts = Queue()
+            fut = self.run_bg(
+                lambda res, err: self.page_entered(iid, page, res, err),
+                get_datapage, page["site"], page["page"], parts.put)
+            self.poll_found(parts, fut, iid)
         else:
             self.text_info(iid)
 
+    def page_entered(self, iid, page, res, err):
+        if self.pages.get(iid) is not page:
+            # page was deleted while loading
+            return
+        if err is not None:
+            page["entered"] = False
+            self.sstatus(_("Error: {0}").format(err))
+            return
+        items, info, ptype = res
+        if ptype == "Files":
+            self.deflate_datapage(items, info, iid)
+        if ptype == "Catalog":
+            self.insert_pages(items, iid)
+            if info:
+                page["info"] = info
+                self.text_info(iid)
+            self.prefetch(items, self.cfg.setdefault("prefetch-depth", 0))
+
+    def prefetch(self, items, depth):
+        """Speculatively load first child pages of the catalog in the
+        background, so that entering them is instant"""
+        if depth <= 0:
+            return
+        for i in items[:self.cfg.setdefault("prefetch-count", 10)]:
+            if i["hash"] in self.prefetched:
+                self.prefetched.move_to_end(i["hash"])
+                continue
+            # the future stands for the page being loaded
+            fut = self.pfexecutor.submit(get_datapage, i["site"], i["page"])
+            self.prefetched[i["hash"]] = fut
+            self.root.after(200, self.poll_prefetch, fut, i["hash"], depth,
+                            self.pfgen)
+        self.trim_prefetched()
+
+    def trim_prefetched(self):
+        "forget the oldest prefetched pages over prefetch-keep"
+        keep = max(self.cfg.setdefault("prefetch-keep", 100), 1)
+        while len(self.prefetched) > keep:
+            self.prefetched.popitem(last=False)
+
+    def poll_prefetch(self, fut, phash, depth, gen):
+        if gen != self.pfgen or self.prefetched.get(phash) is not fut:
+            # list was cleared, the page was trimmed away or entered
+            fut.cancel()
+            return
+        if not fut.done():
+            self.root.after(200, self.poll_prefetch, fut, phash, depth, gen)
+            return
+        try:
+            res = fut.result()
+        except Exception:
+            self.prefetched.pop(phash, None)
+            return
+        self.prefetched[phash] = res
+        self.prefetched.move_to_end(phash)
+        if res[2] == "Catalog":
+            self.prefetch(res[0], depth - 1)
+
     def deflate_datapage(self, items, info, iid):
         if items:
             if info:
                 self.pages[iid]["info"] = info
                 self.text_info(iid)
             tids = []
-            for u, f in items:
-                tid = self.tree.insert(iid, "end", text=f, tags=("file",))
-                self.ufid.append((u, f, tid, iid))
+            for n, (u, f) in enumerate(items):
+                tid = "%s:%d" % (iid, n)
+                self.files[tid] = (u, f, iid)
                 tids.append(tid)
             self.pages[iid]["contains"] = tids
+            if self.tree.item(iid, "open"):
+                self.insert_files(iid)
+            else:
+                # file nodes are created when the page is opened
+                self.pages[iid]["lazy"] = True
+                self.tree.insert(iid, "end", iid + ":", text="...")
             self.sstatus(_("OK"))
         else:
             self.del_page(iid)
             self.sstatus(_("Bad item detected and destroyed"))
 
+    def open_page(self, evt=None):
+        iid = self.tree.focus()
+        page = self.pages.get(iid)
+        if page is not None and page.pop("lazy", False):
+            self.tree.delete(iid + ":")
+            self.insert_files(iid)
+
+    def insert_files(self, iid):
+        files = self.files
+        self.insert_rows(iid, [(tid, files[tid][1], ("file",))
+                               for tid in self.pages[iid]["contains"]],
+                         files)
+
     def text_info(self, iid):
         if self.text_curinfo != iid:
             self.text_curinfo = iid
@@ -315,46 +573,71 @@ class Face:
             text["state"] = "disabled"
 
     def enter_file(self, evt=None):
-        sel = self.tree.selection()
-        ufids = []
-        for i in self.ufid:
-            if i[2] in sel:
-                ufids.append(i)
+        files = self.files
         ddir = self.dirname.get()
-        for t in ufids:
-            iid = t[3]
+        for tid in self.tree.selection():
+            if tid not in files:
+                continue
+            url, fname, iid = files[tid]
             odir = ddir
             if iid in self.remember:
                 odir = self.remember[iid].get("folder", odir)
-            self.loader.add_file(t[0], join(odir, t[1]))
+            self.loader.add_file(url, join(odir, fname))
 
     def on_delete(self):
         cfg = self.cfg
-        cfg["remembered"] = self.remember
         cfg["last-dir"] = self.dirname.get()
         cfg["geometry"] = self.root.geometry()
         cfg["sashpos"] = self.pw.sashpos(0)
+        cfg["sashpos1"] = self.pw.sashpos(1)
         cfg["sites"] = set({i[0] for i in self.sites if i[2].get()})
+        cfg["offline-search"] = self.offline.get()
         cfg.save()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.pfexecutor.shutdown(wait=False, cancel_futures=True)
         self.root.destroy()
 
-    def sstatus(self, msg):
-        self.slock.acquire()
-        self.status.set(msg)
-        self.slock.release()
+    def sstatus(self, msg, fname=None):
+        """Post status message. It is safe to call from any thread: the
+        messages are shown by drain_status in the Tk thread."""
+        self.events.put((fname, msg))
+
+    def drain_status(self):
+        "show only the last message for each file ten times per second"
+        latest = {}
+        try:
+            while True:
+                fname, msg = self.events.get_nowait()
+                latest[fname] = msg
+        except Empty:
+            pass
+        dltree = self.dltree
+        for fname, msg in latest.items():
+            if fname is None:
+                self.status.set(msg)
+            elif msg is None:
+                if dltree.exists(fname):
+                    dltree.delete(fname)
+            elif dltree.exists(fname):
+                dltree.set(fname, "progress", msg)
+            else:
+                dltree.insert("", "end", fname, text=basename(fname),
+                              values=(msg,))
+        self.root.after(100, self.drain_status)
+
+    def cancel_download(self, evt=None):
+        "remove selected files from the queue"
+        for fname in self.dltree.selection():
+            self.loader.cancel(fname)
+
+    def download_first(self, evt=None):
+        "load selected files as soon as possible"
+        for fname in reversed(self.dltree.selection()):
+            self.loader.to_front(fname)
 
 
 def start_face():
-    try:
-        import gettext
-    except ImportError:
-        __builtins__.__dict__["_"] = str
-    else:
-        localedir = join(dirname(__file__), "i18n", "locale")
-        if isdir(localedir):
-            gettext.install("jml", localedir=localedir)
-        else:
-            gettext.install("jml")
+    install_gettext()
     root = Tk()
     f = Face(root)
     root.mainloop()
@@ -0,0 +1,183 @@
+# Copyright 2015 Serhiy Lysovenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Crash-safe journal of the download queue
+"""
+
+import json
+import os
+from threading import Lock
+
+
+class JsonLog:
+    """Append-only log of JSON lists, one per line. Subclasses restore
+    their state from the records in apply() and give the records of the
+    live state by snapshot(); the log is rewritten with them when it
+    grows too long. A torn last line left by a crash is cut off before
+    anything is appended. If the file can not be opened for writing,
+    the changes are kept in memory only."""
+    def __init__(self, path):
+        self.path = path
+        self.records = 0
+        self.fp = None
+        self.load()
+        try:
+            self.fp = open(path, "a")
+        except OSError:
+            pass
+
+    def apply(self, rec):
+        "restore the state from the record"
+        raise NotImplementedError
+
+    def snapshot(self):
+        "list of records of the live state"
+        raise NotImplementedError
+
+    def live(self):
+        "number of live items"
+        raise NotImplementedError
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as fp:
+                data = fp.read()
+        except OSError:
+            return
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            # torn last line after a crash: cut it off, so that the next
+            # record starts on its own line
+            try:
+                with open(self.path, "r+b") as fp:
+                    fp.truncate(end)
+            except OSError:
+                pass
+        for line in data[:end].decode("utf-8", "replace").splitlines():
+            try:
+                self.apply(json.loads(line))
+            except (ValueError, IndexError, TypeError, KeyError):
+                # damaged record
+                continue
+            self.records += 1
+
+    def write(self, rec, sync=False):
+        "append the record"
+        if self.fp is None:
+            return
+        try:
+            self.fp.write(json.dumps(rec) + "\n")
+            self.fp.flush()
+            if sync:
+                os.fsync(self.fp.fileno())
+        except OSError:
+            self.drop()
+            return
+        self.records += 1
+        if self.records > 2 * self.live() + 256:
+            self.compact()
+
+    def compact(self):
+        "rewrite the log with the records of the live state"
+        recs = self.snapshot()
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as fp:
+                for rec in recs:
+                    fp.write(json.dumps(rec) + "\n")
+                fp.flush()
+                os.fsync(fp.fileno())
+            self.fp.close()
+            os.replace(tmp, self.path)
+            self.fp = open(self.path, "a")
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            self.drop()
+            return
+        self.records = len(recs)
+
+    def drop(self):
+        "go on in memory only after the file failed"
+        try:
+            self.fp.close()
+        except OSError:
+            pass
+        self.fp = None
+
+
+class Journal(JsonLog):
+    """Log of the download queue. Every line is a JSON list:
+    ["+", url, fname, priority] - item was queued,
+    ["%", url, fname, remains] - item was partially loaded,
+    ["-", url, fname] - item was loaded or cancelled."""
+    def __init__(self, path):
+        self.jlock = Lock()
+        self.items = {}
+        JsonLog.__init__(self, path)
+
+    def apply(self, rec):
+        key = (rec[1], rec[2])
+        if rec[0] == "+":
+            self.items[key] = [rec[3], None]
+        elif rec[0] == "%" and key in self.items:
+            self.items[key][1] = rec[3]
+        elif rec[0] == "-":
+            self.items.pop(key, None)
+
+    def live(self):
+        return len(self.items)
+
+    def snapshot(self):
+        recs = []
+        for (url, fname), (priority, remains) in self.items.items():
+            recs.append(["+", url, fname, priority])
+            if remains is not None:
+                recs.append(["%", url, fname, remains])
+        return recs
+
+    def pending(self):
+        "list of (url, fname, priority) to be loaded"
+        self.jlock.acquire()
+        try:
+            return [(k[0], k[1], v[0]) for k, v in self.items.items()]
+        finally:
+            self.jlock.release()
+
+    def add(self, url, fname, priority=0):
+        self.jlock.acquire()
+        try:
+            self.items[(url, fname)] = [priority, None]
+            self.write(["+", url, fname, priority], True)
+        finally:
+            self.jlock.release()
+
+    def progress(self, url, fname, remains):
+        self.jlock.acquire()
+        try:
+            if (url, fname) in self.items:
+                self.items[(url, fname)][1] = remains
+                self.write(["%", url, fname, remains])
+        finally:
+            self.jlock.release()
+
+    def done(self, url, fname):
+        self.jlock.acquire()
+        try:
+            if self.items.pop((url, fname), None) is not None:
+                self.write(["-", url, fname], True)
+        finally:
+            self.jlock.release()
@@ -15,67 +15,433 @@
 Loader
 """
 
-from os.path import basename
-from threading import Thread, Lock
+from email.utils import parsedate_tz, mktime_tz
+from hashlib import sha256
+from heapq import heappush, heappop, heapify
+from http.client import HTTPException
+from itertools import count
+from mmap import mmap, ACCESS_READ
+from random import random
+from threading import Thread, Lock, Timer
 from time import time, mktime, strptime, timezone, sleep
 import os.path as osp
 from urllib.error import HTTPError, URLError
-from urllib.request import urlopen, Request
+from urllib.request import Request
+from pool import urlopen
+
+
+class DlQueue:
+    """Priority queue of (url, fname) pairs. Lower priority values are
+    loaded first, equal priorities keep the order of addition. Deferred
+    items wait in the separate heap until their time comes."""
+    def __init__(self):
+        self.heap = []
+        self.later = []
+        self.items = {}
+        self.names = {}
+        self.counter = count()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        "iterate over queued items in loading order"
+        for entry in sorted(self.items.values()):
+            yield entry[2], entry[3]
+
+    def takes(self, key, priority=0):
+        "True if push would add the item or raise its priority"
+        return key not in self.items or priority < self.items[key][0]
+
+    def push(self, url, fname, priority=0):
+        "add item; returns False if the same item is already queued"
+        key = (url, fname)
+        if not self.takes(key, priority):
+            return False
+        if key in self.items:
+            self.remove(key)
+        entry = [priority, next(self.counter), url, fname, True]
+        self.items[key] = entry
+        self.names.setdefault(fname, set()).add(key)
+        heappush(self.heap, entry)
+        return True
+
+    def defer(self, url, fname, not_before, priority=0):
+        "add item which is not loaded before not_before time"
+        key = (url, fname)
+        if key in self.items:
+            return False
+        entry = [priority, next(self.counter), url, fname, True]
+        self.items[key] = entry
+        self.names.setdefault(fname, set()).add(key)
+        heappush(self.later, (not_before, entry[1], entry))
+        return True
+
+    def ready(self):
+        "move due deferred items to the queue; True if pop would succeed"
+        now = time()
+        while self.later and self.later[0][0] <= now:
+            entry = heappop(self.later)[2]
+            if entry[4]:
+                heappush(self.heap, entry)
+        while self.heap and not self.heap[0][4]:
+            heappop(self.heap)
+        return bool(self.heap)
+
+    def due(self):
+        "time when the first deferred item is ready or None"
+        while self.later and not self.later[0][2][4]:
+            heappop(self.later)
+        if self.later:
+            return self.later[0][0]
+        return None
+
+    def pop(self, accept=None):
+        """remove and return the first ready item; if accept is given,
+        the first one for which accept(key) is true"""
+        self.ready()
+        skipped = []
+        try:
+            while self.heap:
+                entry = heappop(self.heap)
+                if not entry[4]:
+                    continue
+                key = (entry[2], entry[3])
+                if accept is not None and not accept(key):
+                    skipped.append(entry)
+                    continue
+                del self.items[key]
+                self.forget_name(key)
+                return key
+            raise IndexError("pop from empty queue")
+        finally:
+            for entry in skipped:
+                heappush(self.heap, entry)
+
+    def remove(self, key):
+        entry = self.items.pop(key)
+        entry[4] = False
+        self.forget_name(key)
+        if len(self.heap) > 2 * len(self.items) + 64:
+            self.heap = [i for i in self.heap if i[4]]
+            heapify(self.heap)
+
+    def forget_name(self, key):
+        keys = self.names[key[1]]
+        keys.discard(key)
+        if not keys:
+            del self.names[key[1]]
+
+    def cancel(self, fname):
+        "remove all queued items saved to fname and return them"
+        keys = list(self.names.get(fname, ()))
+        for key in keys:
+            self.remove(key)
+        return keys
+
+    def to_front(self, fname):
+        "move items saved to fname to the head of the queue"
+        keys = list(self.names.get(fname, ()))
+        if not keys:
+            return False
+        first = min(i[0] for i in self.items.values())
+        for key in keys:
+            self.push(key[0], key[1], first - 1)
+        return True
 
 
 class Loader:
-    def __init__(self, sstatus):
+    """Status callback is called as sstatus(msg) for general messages and
+    as sstatus(msg, fname) for progress of the file. msg is None when
+    the file leaves the queue. The file which failed keeps its error
+    message until it is cancelled or added again."""
+    def __init__(self, sstatus, workers=1, segments=1, journal=None):
         self.sstatus = sstatus
+        self.journal = journal
         self.qlock = Lock()
-        self.running = False
-        self.queue = []
-        self.__delay = None
+        self.running = 0
+        self.queue = DlQueue()
+        self.workers = 1
+        self.set_workers(workers)
+        self.set_segments(segments)
+        self.bucket = TokenBucket()
+        self.cap = 0.
+        self.verify = False
+        self.policy = RetryPolicy()
+        # (url, fname) -> [attempts, remains, Checksum] of deferred items
+        self.tries = {}
+        # (url, fname) of the items being loaded
+        self.active = set()
+        # (url, fname) -> error of the items given up
+        self.failed = {}
+        # one timer wakes the workers up for the first deferred item
+        self.timer = None
+        self.timer_at = None
+
+    def add_file(self, url, fname, priority=0, journal=True):
+        """queue the item unless it is queued or being loaded already"""
+        if journal and self.journal is not None:
+            # the journal goes first and without qlock, so that the
+            # workers do not wait for the disk
+            self.qlock.acquire()
+            fresh = (url, fname) not in self.active and \
+                self.queue.takes((url, fname), priority)
+            self.qlock.release()
+            if fresh:
+                self.journal.add(url, fname, priority)
+        self.qlock.acquire()
+        if (url, fname) not in self.active and \
+                self.queue.push(url, fname, priority):
+            self.failed.pop((url, fname), None)
+            self.sstatus(_("Queued"), fname)
+        if self.running < self.workers:
+            self.start_worker()
+        self.qlock.release()
 
-    def add_file(self, url, fname):
+    def resume(self):
+        "queue again items left in the journal by previous session"
+        if self.journal is not None:
+            for url, fname, priority in self.journal.pending():
+                self.add_file(url, fname, priority, False)
+
+    def cancel(self, fname):
+        """remove queued items which are saved to fname and forget the
+        failed ones; returns the number of removed queued items"""
         self.qlock.acquire()
-        self.queue.append((url, fname))
-        if not self.running:
-            t = Thread(target=self.t_load)
-            t.daemon = True
-            t.start()
+        res = self.queue.cancel(fname)
+        # deferred items are active while they wait in the queue
+        self.active.difference_update(res)
+        failed = [i for i in self.failed if i[1] == fname]
+        for key in failed:
+            del self.failed[key]
         self.qlock.release()
+        for url, fname in res + failed:
+            self.tries.pop((url, fname), None)
+            if self.journal is not None:
+                self.journal.done(url, fname)
+            self.sstatus(None, fname)
+        return len(res)
 
-    def set_delay(self, delay):
+    def to_front(self, fname):
+        "load fname as soon as a worker becomes free"
+        self.qlock.acquire()
+        res = self.queue.to_front(fname)
+        self.qlock.release()
+        return res
+
+    def start_worker(self):
+        "start one more loader thread (qlock must be held)"
+        self.running += 1
+        t = Thread(target=self.t_load)
+        t.daemon = True
+        t.start()
+
+    def set_workers(self, workers):
         try:
-            res = float(delay)
-        except ValueError:
-            res = None
-        if isinstance(res, float) and (res < 0. or res > 5):
-            res = None
-        self.__delay = res
+            res = int(workers)
+        except (TypeError, ValueError):
+            res = 1
+        self.qlock.acquire()
+        self.workers = min(max(res, 1), 16)
+        while self.running < min(self.workers, len(self.queue)):
+            self.start_worker()
+        self.qlock.release()
 
-    def t_load(self):
-        "loader thread"
-        sis = self.sstatus
+    def set_rate(self, rate, cap=0):
+        """set total and per download bandwidth limits in bytes per second,
+        zero means no limit"""
+        self.bucket.set_rate(rate)
+        try:
+            self.cap = max(float(cap), 0.)
+        except (TypeError, ValueError):
+            self.cap = 0.
+
+    def set_segments(self, segments):
+        try:
+            res = int(segments)
+        except (TypeError, ValueError):
+            res = 1
+        self.segments = min(max(res, 1), 16)
+
+    def set_verify(self, verify):
+        "hash loaded files again from the disk"
+        self.verify = bool(verify)
+
+    def set_retries(self, attempts):
+        self.policy.set_attempts(attempts)
+
+    def wake_up(self):
+        "start a worker for the deferred items which are ready"
         self.qlock.acquire()
-        self.running = True
+        self.timer = None
+        if self.queue.ready() and self.running < self.workers:
+            self.start_worker()
+        self.arm()
         self.qlock.release()
+
+    def arm(self):
+        "set the timer for the first deferred item (qlock must be held)"
+        due = self.queue.due()
+        if due is None or self.timer is not None and self.timer_at <= due:
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer_at = due
+        self.timer = Timer(max(due - time(), 0.), self.wake_up)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def t_load(self):
+        "loader thread"
         while True:
             self.qlock.acquire()
-            if self.queue:
-                uft = self.queue.pop(0)
+            if self.running <= self.workers and self.queue.ready():
+                uft = self.queue.pop()
+                self.active.add(uft)
+                qlen = len(self.queue)
             else:
-                self.running = False
+                self.running -= 1
+                running = self.running
+                qlen = len(self.queue)
                 self.qlock.release()
                 break
             self.qlock.release()
-            sst = _("%%s\t%s (%%d in queue)") % \
-                basename(uft[1]).replace("%", "%%")
-            wwp = lambda x, y=self.queue: sis(sst % (x, len(y)))
-            rb = -1
-            ra = None
-            while rb != ra:
-                rb = ra
-                ra = load_file(uft[0], uft[1], wwp)
-        sis(_("Done"))
-
-
-def load_file(url, outfile, wwp, delay=None):
+            self.sstatus(_("%d in queue") % qlen)
+            deferred = False
+            try:
+                deferred = self.load(uft)
+            except Exception as err:
+                # the worker must go on with the rest of the queue
+                self.give_up(uft, err)
+            if not deferred:
+                # deferred item is in the queue, it is released by the
+                # worker which loads it at last
+                self.qlock.acquire()
+                self.active.discard(uft)
+                self.qlock.release()
+        if not running and not qlen:
+            self.sstatus(_("Done"))
+
+    def load(self, uft):
+        """One attempt to load the item, it is deferred if fails. Returns
+        True if the item is deferred."""
+        wwp = lambda x, f=uft[1]: self.sstatus(x, f)
+        limits = (self.bucket, TokenBucket(self.cap))
+        tries = self.tries.pop(uft, None) or [0, None, Checksum()]
+        size = tries[2].size
+        try:
+            ra = load_segmented(uft[0], uft[1], wwp, self.segments, limits,
+                                tries[2])
+        except RETRY_ERRORS as err:
+            return self.retry(uft, tries, err, tries[2].size > size)
+        if ra:
+            if self.journal is not None:
+                self.journal.progress(uft[0], uft[1], ra)
+            progress = tries[1] is None or ra < tries[1]
+            tries[1] = ra
+            return self.retry(uft, tries, None, progress)
+        err = verify_file(uft[1], tries[2], self.verify)
+        if err is not None:
+            # the item stays in the journal
+            self.give_up(uft, err)
+            return False
+        if self.journal is not None:
+            self.journal.done(uft[0], uft[1])
+        self.sstatus(None, uft[1])
+        return False
+
+    def give_up(self, uft, err):
+        "keep the error of the failed item on its row"
+        self.qlock.acquire()
+        self.failed[uft] = str(err)
+        self.qlock.release()
+        self.sstatus(_("Error: {0}").format(err), uft[1])
+
+    def retry(self, uft, tries, err, progress):
+        "defer the failed item or give it up; returns True if deferred"
+        wait = self.policy.next_try(tries, err, progress)
+        reason = _("incomplete") if err is None else err
+        if wait is None:
+            if self.journal is not None:
+                self.journal.done(uft[0], uft[1])
+            self.give_up(uft, reason)
+            return False
+        self.qlock.acquire()
+        if self.queue.defer(uft[0], uft[1], time() + wait):
+            self.tries[uft] = tries
+        self.arm()
+        self.qlock.release()
+        self.sstatus(_("{0}, retry in {1:.0f} s").format(reason, wait),
+                     uft[1])
+        return True
+
+
+RETRY_ERRORS = (OSError, HTTPException, EOFError, ValueError)
+
+
+class RetryPolicy:
+    """Decides if and when the failed load is tried again. The delay
+    grows exponentially from base to cap seconds and is randomly reduced
+    by up to jitter part, so that the failed loads do not come back all
+    at once. Client errors (4xx except 408 and 429) and malformed
+    responses are not retried. Retry-After of the response is obeyed."""
+    RETRY_CODES = (408, 429)
+
+    def __init__(self, attempts=5, base=1., cap=600., jitter=0.5):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.jitter = jitter
+
+    def set_attempts(self, attempts):
+        try:
+            self.attempts = max(int(attempts), 0)
+        except (TypeError, ValueError):
+            self.attempts = 5
+
+    def next_try(self, tries, err=None, progress=False):
+        """Count the failed attempt in tries[0] (the count starts anew if
+        some data came) and return the delay or None to give up"""
+        if progress:
+            tries[0] = 0
+        tries[0] += 1
+        return self.delay(tries[0], err)
+
+    def delay(self, attempt, err=None):
+        "seconds to wait before the next attempt or None"
+        if attempt > self.attempts:
+            return None
+        if isinstance(err, HTTPError):
+            if err.code < 500 and err.code not in self.RETRY_CODES:
+                return None
+            after = retry_after(err.headers)
+            if after is not None:
+                return min(after, self.cap)
+        elif isinstance(err, ValueError):
+            return None
+        wait = min(self.base * 2 ** (attempt - 1), self.cap)
+        return wait * (1. - self.jitter * random())
+
+
+def retry_after(info):
+    "seconds from Retry-After header (delay or date) or None"
+    value = info.get("Retry-After") if info is not None else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.)
+    except ValueError:
+        pass
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(mktime_tz(date) - time(), 0.)
+
+
+def load_file(url, outfile, wwp, limits=(), check=None):
+    """Load the rest of the file. Returns the number of bytes which were
+    expected but not received. Received data is hashed by check. Errors
+    of the request and of the transfer are raised."""
     req = Request(url)
     if osp.isfile(outfile):
         res_len = osp.getsize(outfile)
@@ -89,56 +455,374 @@ def load_file(url, outfile, wwp, delay=None):
     lwt = time()
     try:
         hdata = urlopen(req)
-        cont_len = int(hdata.info().get("Content-Length", 0))
-        m_time = mktime(strptime(hdata.info().get("Last-Modified"),
-                                 "%a, %d %b %Y %H:%M:%S %Z")) - timezone
-    except (HTTPError,) as err:
+    except HTTPError as err:
         if err.code == 416:
             wwp(_("Nothing to do"))
             return
-        if err.code < 500 or err.code >= 600:
-            raise
+        raise
+    try:
+        cont_len = int(hdata.info().get("Content-Length", 0))
+    except ValueError:
+        hdata.close()
+        raise
+    m_time = last_modified(hdata.info())
+    if hdata.status != 206:
+        # the whole file is sent
+        open_mode = "wb"
+        res_len = 0
+    if check is not None:
+        check.start(outfile, res_len)
+        check.total = content_total(hdata.info(), res_len + cont_len)
     written = 0
     if cont_len == 0:
+        hdata.close()
         return
-    start = time()
+    est = RateEstimator()
     block_size = min(1024, cont_len)
-    with open(outfile, open_mode) as fo:
+    view = memoryview(bytearray(block_size))
+    with hdata, open(outfile, open_mode) as fo:
         while written < cont_len:
-            if delay:
-                sleep(delay)
-            before = time()
-            try:
-                d_bl = hdata.read(block_size)
-            except Exception:
-                break
-            written += len(d_bl)
-            if len(d_bl) == 0:
+            block_size = limit_block(block_size, limits)
+            if len(view) < block_size:
+                view = memoryview(bytearray(block_size))
+            nbytes = hdata.readinto(view[:block_size])
+            written += nbytes
+            if nbytes == 0:
                 break
-            fo.write(d_bl)
+            fo.write(view[:nbytes])
+            if check is not None:
+                check.update(view[:nbytes])
+            consume(nbytes, limits)
+            est.update(nbytes)
+            block_size = est.block_size(block_size)
             after = time()
-            block_size = best_block_size(after-before, len(d_bl))
-            etime = calc_estimated_time(
-                after - before, len(d_bl), cont_len - written)
             if after - lwt >= 1:
-                wwp("%05.2f%% %sETA" %
-                    ((written + res_len) / (cont_len + res_len) * 100, etime))
+                wwp("%05.2f%% %s %sETA" %
+                    ((written + res_len) / (cont_len + res_len) * 100,
+                     format_rate(est.average()),
+                     est.eta(cont_len - written)))
                 lwt = after
-    osp.os.utime(outfile, (time(), m_time))
+    if m_time is not None:
+        osp.os.utime(outfile, (time(), m_time))
     return cont_len - written
 
 
-def best_block_size(elapsed_time, nbytes):
-    new_min = max(nbytes / 2.0, 1.0)
-    new_max = min(max(nbytes * 2.0, 1.0), 4194304)
-    if elapsed_time < 0.001:
-        return int(new_max)
-    rate = nbytes / elapsed_time
-    if rate > new_max:
-        return int(new_max)
-    if rate < new_min:
-        return int(new_min)
-    return int(rate)
+def content_total(info, default=None):
+    "full size of the file from Content-Range or the default one"
+    crange = info.get("Content-Range", "")
+    try:
+        return int(crange.rsplit("/", 1)[1])
+    except (IndexError, ValueError):
+        return default
+
+
+class Checksum:
+    """SHA-256 of the file computed while it is received. When the load
+    resumes, the part on the disk is hashed first (only if it is not
+    hashed yet). total is the expected size of the file."""
+    def __init__(self):
+        self.hash = None
+        self.size = 0
+        self.total = None
+
+    def start(self, outfile, size):
+        "prepare to receive data at the size offset"
+        if self.hash is not None and self.size == size:
+            return
+        self.hash = sha256()
+        self.size = 0
+        if not size:
+            return
+        with open(outfile, "rb") as fp:
+            while self.size < size:
+                chunk = fp.read(min(size - self.size, 1048576))
+                if not chunk:
+                    break
+                self.update(chunk)
+
+    def drop(self):
+        "data is not received in order, hash is not available"
+        self.hash = None
+
+    def update(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+
+    def hexdigest(self):
+        if self.hash is None:
+            return None
+        return self.hash.hexdigest()
+
+
+def file_digest(fname):
+    "SHA-256 of the file mapped into memory"
+    digest = sha256()
+    with open(fname, "rb") as fp:
+        if osp.os.fstat(fp.fileno()).st_size:
+            with mmap(fp.fileno(), 0, access=ACCESS_READ) as mm:
+                digest.update(mm)
+    return digest.hexdigest()
+
+
+def verify_file(fname, check, rehash=False):
+    """Returns the error message or None if the file has the expected
+    size and, in rehash mode, its content is the same as received. The
+    file is not read if it was not hashed while received (segments)."""
+    try:
+        size = osp.getsize(fname)
+    except OSError as err:
+        return str(err)
+    if check.total is not None and size != check.total:
+        return _("size mismatch, {0} of {1} bytes").format(size, check.total)
+    expected = check.hexdigest() if rehash else None
+    if expected is not None:
+        try:
+            digest = file_digest(fname)
+        except (OSError, ValueError) as err:
+            return str(err)
+        if digest != expected:
+            return _("checksum mismatch")
+    return None
+
+
+def last_modified(info):
+    "get modification time from the response headers"
+    try:
+        return mktime(strptime(info.get("Last-Modified"),
+                               "%a, %d %b %Y %H:%M:%S %Z")) - timezone
+    except (TypeError, ValueError):
+        return None
+
+
+SEG_MIN = 1048576
+
+
+def load_segmented(url, outfile, wwp, segments=1, limits=(), check=None):
+    """Load file by several concurrent byte ranges. Progress of the
+    segments is kept in the sidecar file to make resume possible. The
+    segments arrive out of order, so only the size is checked."""
+    state = outfile + ".seg"
+    if osp.isfile(state) and osp.isfile(outfile):
+        total, m_time, segs = read_state(state)
+    else:
+        if segments < 2 or osp.isfile(outfile) or \
+                not hasattr(osp.os, "pwrite"):
+            return load_file(url, outfile, wwp, limits, check)
+        wwp(_("Connecting..."))
+        total, m_time = probe_ranges(url)
+        if total < segments * SEG_MIN:
+            return load_file(url, outfile, wwp, limits, check)
+        ssize = total // segments
+        segs = [[i * ssize, (i + 1) * ssize, i * ssize]
+                for i in range(segments)]
+        segs[-1][1] = total
+    if check is not None:
+        check.drop()
+        check.total = total
+    fd = osp.os.open(outfile, osp.os.O_RDWR | osp.os.O_CREAT, 0o666)
+    try:
+        if osp.os.fstat(fd).st_size != total:
+            osp.os.ftruncate(fd, total)
+        write_state(state, total, m_time, segs)
+        threads = []
+        for seg in segs:
+            if seg[2] < seg[1]:
+                t = Thread(target=load_segment,
+                           args=(url, seg, fd, limits))
+                t.daemon = True
+                t.start()
+                threads.append(t)
+        est = RateEstimator()
+        done = sum(s[2] - s[0] for s in segs)
+        while threads:
+            threads[0].join(1.)
+            threads = [t for t in threads if t.is_alive()]
+            before = done
+            done = sum(s[2] - s[0] for s in segs)
+            est.update(done - before)
+            write_state(state, total, m_time, segs)
+            wwp("%05.2f%% %s %sETA (%d)" %
+                (done / total * 100, format_rate(est.average()),
+                 est.eta(total - done), len(threads)))
+    finally:
+        osp.os.close(fd)
+    if done == total:
+        osp.os.remove(state)
+        if m_time is not None:
+            osp.os.utime(outfile, (time(), m_time))
+    return total - done
+
+
+def load_segment(url, seg, fd, limits=()):
+    "loader thread of the segment [start, end, position]"
+    req = Request(url)
+    req.add_header("Range", "bytes=%d-%d" % (seg[2], seg[1] - 1))
+    try:
+        hdata = urlopen(req)
+    except (HTTPError, URLError):
+        return
+    if hdata.status != 206:
+        hdata.close()
+        return
+    est = RateEstimator()
+    block_size = 1024
+    view = memoryview(bytearray(block_size))
+    while seg[2] < seg[1]:
+        block_size = limit_block(block_size, limits)
+        if len(view) < block_size:
+            view = memoryview(bytearray(block_size))
+        try:
+            nbytes = hdata.readinto(view[:min(block_size, seg[1] - seg[2])])
+        except (OSError, HTTPException):
+            # the rest of the segment is loaded on the next attempt
+            break
+        if nbytes == 0:
+            break
+        osp.os.pwrite(fd, view[:nbytes], seg[2])
+        seg[2] += nbytes
+        consume(nbytes, limits)
+        est.update(nbytes)
+        block_size = est.block_size(block_size)
+    hdata.close()
+
+
+def probe_ranges(url):
+    "returns total length and modification time if ranges are supported"
+    req = Request(url)
+    req.add_header("Range", "bytes=0-0")
+    try:
+        hdata = urlopen(req)
+    except (HTTPError, URLError):
+        return 0, None
+    info = hdata.info()
+    hdata.read()
+    hdata.close()
+    crange = info.get("Content-Range", "")
+    if hdata.status != 206 or "/" not in crange:
+        return 0, None
+    try:
+        total = int(crange.rsplit("/", 1)[1])
+    except ValueError:
+        return 0, None
+    return total, last_modified(info)
+
+
+def read_state(state):
+    "read segments state: first line is total and mtime, then segments"
+    with open(state) as fp:
+        total, m_time = fp.readline().split()
+        segs = [[int(i) for i in line.split()] for line in fp
+                if not line.isspace()]
+    m_time = float(m_time) if m_time != "-" else None
+    return int(total), m_time, segs
+
+
+def write_state(state, total, m_time, segs):
+    with open(state + ".tmp", "w") as fp:
+        fp.write("%d %s\n" % (total, "-" if m_time is None else m_time))
+        for seg in segs:
+            fp.write("%d %d %d\n" % tuple(seg))
+    osp.os.replace(state + ".tmp", state)
+
+
+class TokenBucket:
+    """Bandwidth limiter shared by transfers. Rate is in bytes per second,
+    zero means no limit. Up to one second of unused rate may be spent
+    at once."""
+    def __init__(self, rate=0):
+        self.block = Lock()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        try:
+            rate = max(float(rate), 0.)
+        except (TypeError, ValueError):
+            rate = 0.
+        self.block.acquire()
+        self.rate = rate
+        self.tokens = 0.
+        self.stamp = time()
+        self.block.release()
+
+    def reserve(self, nbytes):
+        "take nbytes from the bucket and return time to wait for them"
+        if not self.rate:
+            return 0.
+        self.block.acquire()
+        now = time()
+        self.tokens = min(self.tokens + (now - self.stamp) * self.rate,
+                          self.rate) - nbytes
+        self.stamp = now
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.
+        self.block.release()
+        return wait
+
+
+def consume(nbytes, limits):
+    "wait until all limiters allow nbytes"
+    wait = max([i.reserve(nbytes) for i in limits] + [0.])
+    if wait > 0:
+        sleep(wait)
+
+
+def limit_block(block_size, limits):
+    "do not read more than quarter of a second of the limited rate"
+    for i in limits:
+        if i.rate:
+            block_size = min(block_size, max(int(i.rate / 4), 1))
+    return block_size
+
+
+class RateEstimator:
+    """Transfer rate smoothed by exponentially weighted moving average of
+    the rates measured over short windows. It drives both the block size
+    and the estimated time."""
+    def __init__(self, window=0.5, alpha=0.3):
+        self.window = window
+        self.alpha = alpha
+        self.start = self.wstart = time()
+        self.total = 0
+        self.wbytes = 0
+        self.rate = None
+
+    def update(self, nbytes):
+        now = time()
+        self.total += nbytes
+        self.wbytes += nbytes
+        span = now - self.wstart
+        if span >= self.window:
+            cur = self.wbytes / span
+            if self.rate is None:
+                self.rate = cur
+            else:
+                self.rate += self.alpha * (cur - self.rate)
+            self.wstart = now
+            self.wbytes = 0
+
+    def current(self):
+        "smoothed rate, or the average one until the first window ends"
+        if self.rate is None:
+            return self.average()
+        return self.rate
+
+    def average(self):
+        elapsed = time() - self.start
+        if elapsed < 0.001:
+            return 0.
+        return self.total / elapsed
+
+    def block_size(self, block_size):
+        return best_block_size(self.current(), block_size)
+
+    def eta(self, ebytes):
+        return calc_estimated_time(1., self.current(), ebytes)
+
+
+def best_block_size(rate, block_size):
+    "about one second of transfer, at most twice as less or more as before"
+    new_min = max(block_size / 2.0, 1.0)
+    new_max = min(max(block_size * 2.0, 1.0), 4194304)
+    return int(min(max(rate, new_min), new_max))
 
 
 def calc_estimated_time(elapsed, nbytes, ebytes):
@@ -150,3 +834,11 @@ def calc_estimated_time(elapsed, nbytes, ebytes):
     if hours > 99:
         return "--:--:--"
     return "%02d:%02d:%02d" % (hours, minutes, seconds)
+
+
+def format_rate(rate):
+    for unit in ("B/s", "KiB/s", "MiB/s"):
+        if rate < 1024.:
+            return "%.1f %s" % (rate, unit)
+        rate /= 1024.
+    return "%.1f GiB/s" % rate
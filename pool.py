@@ -0,0 +1,202 @@
+# Copyright 2015 Serhiy Lysovenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Pool of keep-alive HTTP connections shared by the loader and the sites
+"""
+
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from io import BytesIO
+from sys import version_info
+from threading import Lock
+from time import time
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit, urljoin
+from urllib.request import Request, getproxies, proxy_bypass, \
+    urlopen as proxy_urlopen
+
+TIMEOUT = 60.
+IDLE_TIMEOUT = 30.
+MAX_IDLE = 4
+REDIRECTS = 5
+USER_AGENT = "Python-urllib/%d.%d" % version_info[:2]
+
+
+class Pool:
+    "Idle connections are kept per (scheme, host) and evicted by age"
+    def __init__(self, idle_timeout=IDLE_TIMEOUT, max_idle=MAX_IDLE):
+        self.plock = Lock()
+        self.idle = {}
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+
+    def get(self, key, timeout):
+        "returns connection and flag whether it was used before"
+        self.plock.acquire()
+        self.evict()
+        conns = self.idle.get(key)
+        conn = conns.pop()[0] if conns else None
+        self.plock.release()
+        if conn is not None:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return conn, True
+        return self.connect(key, timeout), False
+
+    def connect(self, key, timeout):
+        if key[0] == "https":
+            return HTTPSConnection(key[1], timeout=timeout)
+        return HTTPConnection(key[1], timeout=timeout)
+
+    def put(self, key, conn):
+        self.plock.acquire()
+        conns = self.idle.setdefault(key, [])
+        conns.append((conn, time()))
+        while len(conns) > self.max_idle:
+            conns.pop(0)[0].close()
+        self.evict()
+        self.plock.release()
+
+    def evict(self):
+        "close connections idle for too long (plock must be held)"
+        oldest = time() - self.idle_timeout
+        for key in list(self.idle):
+            conns = self.idle[key]
+            while conns and conns[0][1] < oldest:
+                conns.pop(0)[0].close()
+            if not conns:
+                del self.idle[key]
+
+    def clear(self):
+        self.plock.acquire()
+        for conns in self.idle.values():
+            for conn, itime in conns:
+                conn.close()
+        self.idle.clear()
+        self.plock.release()
+
+    def urlopen(self, url, timeout=TIMEOUT):
+        """Works like urllib.request.urlopen for GET requests. url may be
+        a string or a Request. The URLs which go through a proxy
+        (http_proxy, https_proxy and no_proxy) are left to urllib."""
+        if use_proxy(url.full_url if isinstance(url, Request) else url):
+            return proxy_urlopen(url, timeout=timeout)
+        headers = {"User-Agent": USER_AGENT}
+        if isinstance(url, Request):
+            headers.update(url.header_items())
+            url = url.full_url
+        for i in range(REDIRECTS):
+            parts = urlsplit(url)
+            key = (parts.scheme, parts.netloc)
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+            conn, reused = self.get(key, timeout)
+            try:
+                conn.request("GET", path, headers=headers)
+                resp = conn.getresponse()
+            except (HTTPException, OSError) as err:
+                conn.close()
+                if not reused:
+                    raise URLError(err)
+                # server has closed the idle connection, try fresh one
+                conn = self.connect(key, timeout)
+                try:
+                    conn.request("GET", path, headers=headers)
+                    resp = conn.getresponse()
+                except (HTTPException, OSError) as err:
+                    conn.close()
+                    raise URLError(err)
+            if resp.status in (301, 302, 303, 307, 308) and \
+                    resp.getheader("Location"):
+                resp.read()
+                self.release(key, conn, resp)
+                url = urljoin(url, resp.getheader("Location"))
+                continue
+            if resp.status >= 400:
+                body = resp.read()
+                self.release(key, conn, resp)
+                raise HTTPError(url, resp.status, resp.reason, resp.msg,
+                                BytesIO(body))
+            return Response(self, key, conn, resp, url)
+        # the last connection is released already
+        raise HTTPError(url, resp.status, "Too many redirects", resp.msg,
+                        None)
+
+    def release(self, key, conn, resp):
+        "return connection to the pool if the response was read"
+        if resp.isclosed() and not resp.will_close:
+            self.put(key, conn)
+        else:
+            resp.close()
+            conn.close()
+
+
+class Response:
+    "Returns the connection to the pool when the body is read or closed"
+    def __init__(self, pool, key, conn, resp, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.resp = resp
+        self.url = url
+        self.status = resp.status
+        self.reason = resp.reason
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def info(self):
+        return self.resp.msg
+
+    def geturl(self):
+        return self.url
+
+    def getheader(self, name, default=None):
+        return self.resp.getheader(name, default)
+
+    def read(self, amt=None):
+        data = self.resp.read(amt)
+        if self.resp.isclosed():
+            self.close()
+        return data
+
+    def readinto(self, buf):
+        nbytes = self.resp.readinto(buf)
+        if self.resp.isclosed():
+            self.close()
+        return nbytes
+
+    def close(self):
+        if self.conn is not None:
+            self.pool.release(self.key, self.conn, self.resp)
+            self.conn = None
+
+
+def use_proxy(url):
+    "True if the proxy of the environment is set for the URL"
+    parts = urlsplit(url)
+    if parts.scheme not in getproxies():
+        return False
+    return not proxy_bypass(parts.hostname or "")
+
+
+POOL = Pool()
+
+
+def urlopen(url, timeout=TIMEOUT):
+    return POOL.urlopen(url, timeout)
@@ -15,24 +15,119 @@
 Deal with application's settings
 """
 
-from os.path import expanduser
+from ast import literal_eval
+import json
+import os
+from os.path import expanduser, isdir, isfile, join, dirname
+from journal import JsonLog
+
+
+def write_json(path, obj):
+    "atomic write: the file is either old or new after a crash"
+    tmp = path + ".tmp"
+    with open(tmp, "w") as fp:
+        json.dump(obj, fp, indent=1, sort_keys=True,
+                  default=lambda o: sorted(o))
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp, path)
 
 
 class Config(dict):
-    def __init__(self):
-        self.path = expanduser("~/.jml")
-        cfgl = []
+    """Settings are stored in ~/.jml.json, bookmarks are kept apart in
+    ~/.jml-bookmarks and are read on the first access to the bookmarks
+    property, so a large collection does not delay loading of the
+    settings. The settings of
+    the old format (~/.jml) are converted once. Sets are saved as
+    lists."""
+    def __init__(self, path=None):
+        self.path = path or expanduser("~/.jml.json")
+        self._bookmarks = None
         try:
             with open(self.path) as fp:
-                for line in iter(fp.readline, ""):
-                    if not line.isspace():
-                        nam, val = line.strip().split(": ", 1)
-                        cfgl.append((nam, eval(val)))
-        except:
+                dict.__init__(self, json.load(fp))
+        except (OSError, ValueError, TypeError):
+            if not isfile(self.path):
+                self.migrate(expanduser("~/.jml"))
+
+    def migrate(self, legacy):
+        "read settings of the old format"
+        try:
+            fp = open(legacy)
+        except OSError:
+            return
+        with fp:
+            for line in fp:
+                try:
+                    nam, val = line.strip().split(": ", 1)
+                    self[nam] = literal_eval(val)
+                except (ValueError, SyntaxError):
+                    continue
+        remembered = self.pop("remembered", None)
+        if remembered:
+            bookmarks = self.bookmarks
+            for iid, data in remembered.items():
+                bookmarks[iid] = data
+        try:
+            self.save()
+        except OSError:
             pass
-        dict.__init__(self, cfgl)
+
+    @property
+    def bookmarks(self):
+        if self._bookmarks is None:
+            self._bookmarks = Bookmarks(
+                join(dirname(self.path), ".jml-bookmarks"))
+        return self._bookmarks
 
     def save(self):
-        with open(self.path, "w") as fp:
-            for n, v in self.items():
-                fp.write("%s: %s\n" % (n, repr(v)))
+        write_json(self.path, self)
+
+
+class Bookmarks(JsonLog, dict):
+    """Remembered pages: page id -> dict with site, page, title and
+    optionally folder. Every change is appended to the log immediately,
+    so the changed values must be assigned again:
+    ["+", iid, data] - bookmark was added or changed,
+    ["-", iid] - bookmark was removed."""
+    def __init__(self, path):
+        dict.__init__(self)
+        JsonLog.__init__(self, path)
+
+    def apply(self, rec):
+        if rec[0] == "+":
+            dict.__setitem__(self, rec[1], rec[2])
+        elif rec[0] == "-":
+            dict.pop(self, rec[1], None)
+
+    def live(self):
+        return len(self)
+
+    def snapshot(self):
+        return [["+", iid, data] for iid, data in self.items()]
+
+    def __setitem__(self, iid, data):
+        dict.__setitem__(self, iid, data)
+        self.write(["+", iid, data], True)
+
+    def pop(self, iid, *default):
+        if iid not in self:
+            return dict.pop(self, iid, *default)
+        data = dict.pop(self, iid)
+        self.write(["-", iid], True)
+        return data
+
+
+def install_gettext():
+    "install _() into builtins"
+    try:
+        import gettext
+    except ImportError:
+        import builtins
+        builtins._ = str
+    else:
+        localedir = join(dirname(__file__), "i18n", "locale")
+        if isdir(localedir):
+            gettext.install("jml", localedir=localedir)
+        else:
+            gettext.install("jml")
@@ -15,27 +15,133 @@
 Sites hub
 """
 
+from queue import Queue, Empty
+from threading import Thread
+from time import time
+from urllib.parse import urlsplit
 import ex_ua
 import youtube
+from textindex import INDEX
 
 
 _SIT_MDLS = {"ex-ua": ex_ua, "youtube": youtube}
+SEARCH_TIMEOUT = 20.
+_SIT_HOSTS = {"ex.ua": "ex-ua", "www.ex.ua": "ex-ua",
+              "youtube.com": "youtube", "www.youtube.com": "youtube"}
 
 
 def get_sites():
     return [("ex-ua", "EX-UA"), ("youtube", "YouTube")]
 
 
-def web_search(what, where):
-    result = []
-    for i in where:
-        if i in _SIT_MDLS:
-            result += _SIT_MDLS[i].web_search(what)
+def web_search(what, where, timeout=SEARCH_TIMEOUT, report=None,
+               found=None, offline=False):
+    """Searches the sites concurrently. Results of sites which did not
+    answer within timeout are dropped. If report dict is given it gets
+    (latency, error) for every site, error is None on success. If found
+    is given, it is called from the search threads with lists of pages
+    as soon as they are parsed. In offline mode the pages from the local
+    index go first (found gets them at once), the live results which
+    are not among them follow."""
+    sites = [i[0] for i in get_sites() if i[0] in where]
+    local = []
+    if offline:
+        local = local_search(what, where)
+        if found is not None and local:
+            found(local)
+    answers = Queue()
+    for site in sites:
+        t = Thread(target=_search, args=(site, what, answers, found))
+        t.daemon = True
+        t.start()
+    got = {}
+    deadline = time() + timeout
+    while len(got) < len(sites):
+        try:
+            site, res, err, latency = answers.get(
+                timeout=max(deadline - time(), 0.))
+        except Empty:
+            break
+        got[site] = (res, err, latency)
+    result = local
+    seen = {i["hash"] for i in local}
+    for site in sites:
+        if site in got:
+            res, err, latency = got[site]
+            if err is None:
+                result += [i for i in res if i["hash"] not in seen]
+        else:
+            err, latency = _("timeout"), None
+        if report is not None:
+            report[site] = (latency, err)
     return result
 
 
-def get_datapage(site, page):
-    if site in _SIT_MDLS:
-        return _SIT_MDLS[site].get_datapage(page)
+def local_search(what, where):
+    "search the pages fetched before, no requests are sent"
+    return INDEX.search(what, set(where))
+
+
+def _search(site, what, answers, found=None):
+    "search thread"
+    start = time()
+    mdl = _SIT_MDLS[site]
+    try:
+        if found is not None and hasattr(mdl, "iter_search"):
+            res = []
+            for part in mdl.iter_search(what):
+                INDEX.add(part)
+                found(part)
+                res += part
+        else:
+            res = mdl.web_search(what)
+            INDEX.add(res)
+    except Exception as err:
+        answers.put((site, None, str(err), time() - start))
     else:
+        answers.put((site, res, None, time() - start))
+
+
+def get_datapage(site, page, found=None):
+    """found is called with parts of the catalog loaded by crawling
+    its pagination. Titles and info of the pages are indexed."""
+    if site not in _SIT_MDLS:
+        raise KeyError("Wrong site name")
+    if found is not None:
+        found = _indexed(found)
+    res = _SIT_MDLS[site].get_datapage(page, found)
+    if res[2] == "Catalog":
+        INDEX.add(res[0])
+    if res[1]:
+        INDEX.set_info(site, page, res[1])
+    return res
+
+
+def _indexed(found):
+    def wrapper(part):
+        INDEX.add(part)
+        found(part)
+    return wrapper
+
+
+def set_crawl(cap=0, workers=4, delay=0.5):
+    "set pagination crawling for the sites which support it"
+    for mdl in _SIT_MDLS.values():
+        if hasattr(mdl, "set_crawl"):
+            mdl.set_crawl(cap, workers, delay)
+
+
+def parse_page(spec):
+    """Returns (site, page) for the page URL or for "site:/page" spec"""
+    parts = urlsplit(spec)
+    if parts.netloc:
+        if parts.netloc not in _SIT_HOSTS:
+            raise KeyError("Wrong site name")
+        page = parts.path
+        if parts.query:
+            page += "?" + parts.query
+        return _SIT_HOSTS[parts.netloc], page
+    site, page = spec.split(":", 1)
+    if site not in _SIT_MDLS:
         raise KeyError("Wrong site name")
+    return site, page
@@ -0,0 +1,90 @@
+# Copyright 2015 Serhiy Lysovenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import builtins
+import os
+import os.path as osp
+import re
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+import pytest
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+builtins._ = str
+
+DATA = os.urandom(3 * 1048576 + 123)
+ETAG = '"jml"'
+MODIFIED = "Mon, 03 Aug 2015 10:00:00 GMT"
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """serves DATA at any path and supports byte ranges; the paths which
+    start with /page have validators (/page?modified only Last-Modified)
+    and are answered by 304 to the conditional requests"""
+    protocol_version = "HTTP/1.1"
+    # (path, headers) of the requests
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers))
+        page = self.path.startswith("/page")
+        if page and (self.headers.get("If-None-Match") == ETAG or
+                     self.headers.get("If-Modified-Since") == MODIFIED):
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        start, end = 0, len(DATA) - 1
+        rng = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if rng:
+            start = int(rng.group(1))
+            if rng.group(2):
+                end = int(rng.group(2))
+            if start >= len(DATA):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range",
+                             "bytes %d-%d/%d" % (start, end, len(DATA)))
+        else:
+            self.send_response(200)
+        if page:
+            if not self.path.endswith("?modified"):
+                self.send_header("ETag", ETAG)
+            self.send_header("Last-Modified", MODIFIED)
+        body = DATA[start:end + 1]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except OSError:
+            pass
+
+
+@pytest.fixture(scope="session")
+def server():
+    "base URL of the local server"
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    t = Thread(target=srv.serve_forever)
+    t.daemon = True
+    t.start()
+    yield "http://127.0.0.1:%d" % srv.server_address[1]
+    srv.shutdown()
+    srv.server_close()
@@ -0,0 +1,89 @@
+# Copyright 2015 Serhiy Lysovenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from hashlib import sha1
+from conftest import DATA, ETAG, MODIFIED, RangeHandler
+from cache import PageCache
+
+
+def requests(url):
+    "headers of the requests of the url made by the cache"
+    path = url.split("/", 3)[3]
+    return [i[1] for i in RangeHandler.requests if i[0] == "/" + path]
+
+
+def key(url):
+    return sha1(url.encode("utf8")).hexdigest()
+
+
+def test_fresh(server, tmp_path):
+    cache = PageCache(str(tmp_path))
+    url = server + "/page/fresh"
+    assert cache.fetch(url) == DATA
+    assert cache.fetch(url) == DATA
+    assert len(requests(url)) == 1
+    # the index is read again by the new cache
+    assert PageCache(str(tmp_path)).fetch(url) == DATA
+    assert len(requests(url)) == 1
+
+
+def test_conditional(server, tmp_path):
+    cache = PageCache(str(tmp_path), ttl=0)
+    url = server + "/page/etag"
+    assert cache.fetch(url) == DATA
+    checked = cache.lookup(key(url))["time"]
+    assert cache.fetch(url) == DATA
+    first, second = requests(url)
+    assert first.get("If-None-Match") is None
+    assert second.get("If-None-Match") == ETAG
+    assert second.get("If-Modified-Since") == MODIFIED
+    # 304 renews the time of the check
+    assert cache.lookup(key(url))["time"] >= checked
+
+
+def test_conditional_modified(server, tmp_path):
+    cache = PageCache(str(tmp_path), ttl=0)
+    url = server + "/page?modified"
+    assert cache.fetch(url) == DATA
+    assert cache.fetch(url) == DATA
+    second = requests(url)[1]
+    assert second.get("If-None-Match") is None
+    assert second.get("If-Modified-Since") == MODIFIED
+
+
+def test_lru(server, tmp_path):
+    cache = PageCache(str(tmp_path), max_size=2 * len(DATA) + 1)
+    urls = [server + "/page/lru%d" % i for i in range(3)]
+    cache.fetch(urls[0])
+    cache.fetch(urls[1])
+    # the use makes the first one the most recent
+    cache.fetch(urls[0])
+    cache.fetch(urls[2])
+    assert cache.lookup(key(urls[1])) is None
+    assert not (tmp_path / key(urls[1])).exists()
+    for url in urls[0], urls[2]:
+        assert cache.lookup(key(url)) is not None
+    assert cache.size == 2 * len(DATA)
+
+
+def test_partial_not_stored(server, tmp_path):
+    cache = PageCache(str(tmp_path))
+    url = server + "/page/partial"
+    chunks = cache.stream(url)
+    assert DATA.startswith(next(chunks))
+    chunks.close()
+    assert cache.lookup(key(url)) is None
+    assert not (tmp_path / key(url)).exists()
+    assert cache.fetch(url) == DATA
+    assert len(requests(url)) == 2
@@ -0,0 +1,56 @@
+# Copyright 2015 Serhiy Lysovenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from glob import glob
+import os.path as osp
+import pytest
+from ex_ua.bench import same_results, synthetic_page, FIXTURES
+from ex_ua.parser import scan_dpage
+
+
+def read(name):
+    with open(osp.join(osp.dirname(FIXTURES), name), encoding="utf-8") as fp:
+        return fp.read()
+
+
+@pytest.mark.parametrize("path", sorted(glob(FIXTURES)), ids=osp.basename)
+def test_same_as_legacy(path):
+    with open(path, encoding="utf-8") as fp:
+        assert same_results(fp.read())
+
+
+def test_same_as_legacy_synthetic():
+    assert same_results(synthetic_page(300, 0))
+    assert same_results(synthetic_page(0, 300))
+
+
+def test_files_page():
+    files, info, links = scan_dpage(read("ex_ua_files.html"))
+    assert files == [
+        ("http://www.ex.ua/get/1001", "House.S01E01.Pilot.flv"),
+        ("http://www.ex.ua/get/1002",
+         "House.S01E02.Paternity & Occam's Razor.flv"),
+        ("http://www.ex.ua/get/1003", "Хаус.С01Е03.Бритва Оккама.flv"),
+        ("http://www.ex.ua/get/1004", "Theme.Teardrop.mp3")]
+    assert info.startswith("<h1>")
+    assert links == []
+
+
+def test_catalog_page():
+    files, info, links = scan_dpage(read("ex_ua_catalog.html"))
+    assert files == []
+    assert [(i["page"], i["title"]) for i in links] == [
+        ("/2001", "Доктор Хаус / House M.D."), ("/2002", "Lost & Found"),
+        ("/2003", "Друзья"), ("/2004", "No title"),
+        ("/2005", "Секретные материалы"), ("/2006", "Шерлок")]
@@ -0,0 +1,77 @@
+# Copyright 2015 Serhiy Lysovenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from journal import Journal
+from load import Loader
+from settings import Bookmarks
+
+
+def test_journal_torn_line(tmp_path):
+    path = tmp_path / "queue"
+    path.write_text('["+", "u1", "f1", 0]\n["+", "u2", "f')
+    journal = Journal(str(path))
+    journal.add("u3", "f3")
+    journal.fp.close()
+    assert Journal(str(path)).pending() == [("u1", "f1", 0), ("u3", "f3", 0)]
+
+
+def test_bookmarks_torn_line(tmp_path):
+    path = tmp_path / "bookmarks"
+    path.write_text('["+", "a", {"title": "A"}]\n["+", "b", {"tit')
+    bookmarks = Bookmarks(str(path))
+    bookmarks["c"] = {"title": "C"}
+    bookmarks.pop("a")
+    bookmarks.fp.close()
+    assert dict(Bookmarks(str(path))) == {"c": {"title": "C"}}
+
+
+def test_bookmarks_compact(tmp_path):
+    path = str(tmp_path / "bookmarks")
+    bookmarks = Bookmarks(path)
+    for i in range(300):
+        bookmarks["x"] = {"title": str(i)}
+    bookmarks.fp.close()
+    assert bookmarks.records < 300
+    assert dict(Bookmarks(path)) == {"x": {"title": "299"}}
+
+
+def test_bookmarks_not_writable(tmp_path):
+    bookmarks = Bookmarks(str(tmp_path / "missing" / "bookmarks"))
+    bookmarks["a"] = {"title": "A"}
+    assert bookmarks.fp is None
+    assert bookmarks["a"] == {"title": "A"}
+
+
+class FullDisk:
+    "file object which fails as on a full disk"
+    def write(self, data):
+        raise OSError(28, "No space left on device")
+
+    def close(self):
+        pass
+
+
+def test_journal_write_error(tmp_path):
+    journal = Journal(str(tmp_path / "queue"))
+    journal.fp = FullDisk()
+    loader = Loader(lambda msg, fname=None: None, journal=journal)
+    # no worker is started for the item, it only has to be queued
+    loader.workers = 0
+    loader.add_file("u1", "f1")
+    assert not loader.qlock.locked() and not journal.jlock.locked()
+    assert journal.fp is None
+    journal.done("u1", "f1")
+    journal.add("u2", "f2")
+    assert journal.pending() == [("u2", "f2", 0)]
+    assert len(loader.queue) == 1
@@ -0,0 +1,215 @@
+# Copyright 2015 Serhiy Lysovenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+from email.utils import formatdate
+from threading import Timer, enumerate as threads
+from time import sleep, time
+from urllib.error import HTTPError
+import pytest
+from conftest import DATA
+import load
+from load import Loader, DlQueue, RetryPolicy, retry_after, Checksum, \
+    verify_file
+from aload import AsyncLoader
+
+
+def wait_for(cond, timeout=30.):
+    deadline = time() + timeout
+    while not cond():
+        assert time() < deadline, "timed out"
+        sleep(0.05)
+
+
+@pytest.mark.parametrize("make", [
+    lambda st: Loader(st, 2),
+    lambda st: AsyncLoader(st, 2),
+], ids=["threads", "async"])
+def test_readd_while_loading(server, tmp_path, make):
+    loader = make(lambda msg, fname=None: None)
+    # about 3 seconds for the file
+    loader.set_rate(1048576)
+    loader.set_verify(True)
+    url = server + "/file"
+    fname = str(tmp_path / "file")
+    loader.add_file(url, fname)
+    wait_for(lambda: (url, fname) in loader.active)
+    sleep(0.5)
+    loader.add_file(url, fname)
+    assert len(loader.queue) == 0
+    wait_for(lambda: not loader.active and not len(loader.queue))
+    with open(fname, "rb") as fp:
+        assert fp.read() == DATA
+    assert loader.failed == {}
+
+
+def test_busy_host_does_not_take_slots(server, tmp_path):
+    loader = AsyncLoader(lambda msg, fname=None: None, 2, 1)
+    loader.set_rate(1048576)
+    busy = [(server + "/file", str(tmp_path / ("busy%d" % i)))
+            for i in range(3)]
+    # the same server under the other host name
+    other = (server.replace("127.0.0.1", "localhost") + "/file",
+             str(tmp_path / "other"))
+    for uft in busy:
+        loader.add_file(*uft)
+    wait_for(lambda: busy[0] in loader.active)
+    loader.add_file(*other)
+    wait_for(lambda: other in loader.active, 2.)
+    assert len(loader.active) == 2
+    loader.set_rate(0)
+    wait_for(lambda: not loader.active and not len(loader.queue))
+    for uft in busy + [other]:
+        with open(uft[1], "rb") as fp:
+            assert fp.read() == DATA
+
+
+def test_queue_order():
+    queue = DlQueue()
+    for i, priority in enumerate((1, 0, 1, 0)):
+        queue.push("u%d" % i, "f%d" % i, priority)
+    assert not queue.push("u1", "f1", 1)
+    assert queue.push("u2", "f2", -1)
+    assert list(queue) == [("u2", "f2"), ("u1", "f1"), ("u3", "f3"),
+                           ("u0", "f0")]
+    assert queue.to_front("f0")
+    assert not queue.to_front("nothing")
+    assert queue.cancel("f1") == [("u1", "f1")]
+    assert queue.cancel("f1") == []
+    assert len(queue) == 3
+    res = []
+    while queue.ready():
+        res.append(queue.pop())
+    assert res == [("u0", "f0"), ("u2", "f2"), ("u3", "f3")]
+
+
+def refused_url():
+    "URL of the port nobody listens on"
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return "http://127.0.0.1:%d/file" % port
+
+
+@pytest.mark.parametrize("make", [
+    lambda st: Loader(st, 2),
+    lambda st: AsyncLoader(st, 2),
+], ids=["threads", "async"])
+def test_readd_after_cancel(tmp_path, make):
+    loader = make(lambda msg, fname=None: None)
+    loader.policy.base = 60.
+    uft = (refused_url(), str(tmp_path / "file"))
+    loader.add_file(*uft)
+    # the failed item waits in the queue for the next attempt
+    wait_for(lambda: uft in loader.tries)
+    assert len(loader.queue) == 1
+    assert loader.cancel(uft[1]) == 1
+    assert uft not in loader.active and not loader.tries
+    loader.add_file(*uft)
+    assert len(loader.queue) == 1
+    assert loader.cancel(uft[1]) == 1
+
+
+@pytest.mark.parametrize("make", [
+    lambda st: Loader(st, 2),
+    lambda st: AsyncLoader(st, 2),
+], ids=["threads", "async"])
+def test_failed_keeps_error(tmp_path, make):
+    rows = {}
+    loader = make(lambda msg, fname=None: fname is not None and
+                  rows.__setitem__(fname, msg))
+    loader.set_retries(0)
+    uft = (refused_url(), str(tmp_path / "file"))
+    loader.add_file(*uft)
+    wait_for(lambda: uft in loader.failed)
+    sleep(0.2)
+    assert rows[uft[1]].startswith("Error: ")
+    assert loader.cancel(uft[1]) == 0
+    assert rows[uft[1]] is None and not loader.failed
+
+
+def http_error(code, headers=None):
+    return HTTPError("http://host/", code, "", headers or {}, None)
+
+
+def test_retry_backoff():
+    policy = RetryPolicy(attempts=20, base=1., cap=600., jitter=0.5)
+    for attempt in range(1, 21):
+        full = min(2. ** (attempt - 1), 600.)
+        for i in range(20):
+            assert full * 0.5 <= policy.delay(attempt) <= full
+    assert policy.delay(21) is None
+    tries = [3, None, None]
+    assert policy.next_try(tries, progress=True) <= 1.
+    assert tries[0] == 1
+
+
+def test_retry_codes():
+    policy = RetryPolicy()
+    assert policy.delay(1, http_error(404)) is None
+    assert policy.delay(1, http_error(403)) is None
+    assert policy.delay(1, ValueError("bad response")) is None
+    for code in (408, 429, 500, 503):
+        assert policy.delay(1, http_error(code)) <= 1.
+    assert policy.delay(1, OSError("reset")) <= 1.
+    assert policy.delay(1, http_error(503, {"Retry-After": "120"})) == 120.
+    assert policy.delay(1, http_error(429, {"Retry-After": "9999"})) == 600.
+
+
+def test_retry_after():
+    assert retry_after(None) is None
+    assert retry_after({}) is None
+    assert retry_after({"Retry-After": "soon"}) is None
+    assert retry_after({"Retry-After": "30"}) == 30.
+    assert retry_after({"Retry-After": "-5"}) == 0.
+    date = formatdate(time() + 100, usegmt=True)
+    assert 95. <= retry_after({"Retry-After": date}) <= 100.
+    date = formatdate(time() - 100, usegmt=True)
+    assert retry_after({"Retry-After": date}) == 0.
+
+
+def test_one_timer(tmp_path):
+    loader = Loader(lambda msg, fname=None: None, 4)
+    loader.policy.base = 60.
+    url = refused_url()
+    ufts = [(url, str(tmp_path / ("file%d" % i))) for i in range(20)]
+    for uft in ufts:
+        loader.add_file(*uft)
+    wait_for(lambda: len(loader.tries) == len(ufts))
+    assert len([i for i in threads() if isinstance(i, Timer) and
+                i.function.__self__ is loader]) == 1
+    for uft in ufts:
+        loader.cancel(uft[1])
+    loader.policy.base = 0.01
+    # the earlier item replaces the timer
+    loader.add_file(*ufts[0])
+    wait_for(lambda: ufts[0] in loader.tries)
+    wait_for(lambda: loader.tries.get(ufts[0], [0])[0] > 1, 5.)
+    loader.cancel(ufts[0][1])
+
+
+def test_verify_without_hash(tmp_path, monkeypatch):
+    fname = tmp_path / "file"
+    fname.write_bytes(b"data")
+    check = Checksum()
+    check.start(str(fname), 4)
+    check.drop()
+    monkeypatch.setattr(load, "file_digest", None)
+    assert verify_file(str(fname), check, True) is None
+    check = Checksum()
+    check.start(str(fname), 0)
+    check.update(b"date")
+    monkeypatch.undo()
+    assert verify_file(str(fname), check, True) is not None
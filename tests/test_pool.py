@@ -0,0 +1,63 @@
+# Copyright 2015 Serhiy Lysovenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.error import HTTPError
+import pytest
+from conftest import DATA
+from pool import Pool
+
+
+class LoopHandler(BaseHTTPRequestHandler):
+    "redirects every request to itself"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(302)
+        self.send_header("Location", "/again")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def test_proxy(server, monkeypatch):
+    # the test server answers any path, so it works as a proxy too
+    monkeypatch.setenv("http_proxy", server)
+    monkeypatch.delenv("no_proxy", raising=False)
+    pool = Pool()
+    with pool.urlopen("http://jml.invalid/file") as resp:
+        assert resp.read() == DATA
+    assert not pool.idle
+
+
+def test_too_many_redirects(monkeypatch):
+    for name in ("http_proxy", "HTTP_PROXY"):
+        monkeypatch.delenv(name, raising=False)
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), LoopHandler)
+    t = Thread(target=srv.serve_forever)
+    t.daemon = True
+    t.start()
+    pool = Pool()
+    try:
+        with pytest.raises(HTTPError):
+            pool.urlopen("http://127.0.0.1:%d/" % srv.server_address[1])
+        # the pooled connection is open and can be used again
+        conns = list(pool.idle.values())[0]
+        assert len(conns) == 1 and conns[0][0].sock is not None
+    finally:
+        srv.shutdown()
+        srv.server_close()
@@ -0,0 +1,38 @@
+# Copyright 2015 Serhiy Lysovenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+from textindex import TextIndex, page_hash
+
+
+def make_page(site, page, title):
+    return {"site": site, "page": page, "title": title,
+            "hash": page_hash(site, page)}
+
+
+@pytest.mark.parametrize("fts", [("fts5",), ("fts4",), ()],
+                         ids=["fts5", "fts4", "memory"])
+def test_search(tmp_path, fts):
+    index = TextIndex(str(tmp_path / "index.sqlite"))
+    index.FTS = fts
+    index.add([make_page("ex-ua", "/1", "Hello world"),
+               make_page("youtube", "/w", "Доктор Хаус")])
+    index.set_info("youtube", "/w", [("Medical drama", ("h1",)),
+                                     ("about a doctor", ())])
+    assert index.fts == (fts[0] if fts else "")
+    assert [i["page"] for i in index.search("hel")] == ["/1"]
+    assert [i["page"] for i in index.search("хау")] == ["/w"]
+    assert [i["page"] for i in index.search("medic doc")] == ["/w"]
+    assert index.search("hello", {"youtube"}) == []
+    assert index.search("missing") == []
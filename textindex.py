@@ -0,0 +1,237 @@
+# Copyright 2015 Serhiy Lysovenko
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Local full-text index of the fetched page titles and info
+"""
+
+from hashlib import md5
+import os
+import os.path as osp
+import re
+from threading import Lock
+from cache import cache_dir
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+LIMIT = 200
+_WORD = re.compile(r"\w+")
+
+
+def index_path():
+    return osp.join(osp.dirname(cache_dir()), "index.sqlite")
+
+
+def page_hash(site, page):
+    "the same hash as the sites give to the found pages"
+    return md5("/".join((site, page)).encode("utf8")).hexdigest()
+
+
+def info_text(info):
+    "plain text of the page info which is a list of (text, tags)"
+    return " ".join(i[0] for i in info if i[0].strip())
+
+
+class TextIndex:
+    """Titles and info texts are kept in SQLite FTS table when it is
+    available and in the in-process inverted index otherwise (the last
+    one is not preserved between the sessions). Errors of the database
+    are ignored: the index is only a hint."""
+    # preferred FTS versions
+    FTS = ("fts5", "fts4")
+
+    def __init__(self, path=None):
+        self.path = path or index_path()
+        self.ilock = Lock()
+        self.db = None
+        self.fts = None
+        # fallback: hash -> [site, page, title, info], word -> {hash}
+        self.records = {}
+        self.words = {}
+
+    def connect(self):
+        "open the database (ilock must be held)"
+        if self.fts is not None:
+            return self.db is not None
+        self.fts = ""
+        if sqlite3 is None:
+            return False
+        try:
+            os.makedirs(osp.dirname(self.path), exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("CREATE TABLE IF NOT EXISTS pages (id INTEGER "
+                       "PRIMARY KEY, hash TEXT UNIQUE, site TEXT, "
+                       "page TEXT, title TEXT)")
+            for fts in self.FTS:
+                try:
+                    # unicode61 folds the case of non-ASCII letters too,
+                    # it is the default one of FTS5 only
+                    db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS ptext "
+                               "USING %s(title, info, tokenize=unicode61)"
+                               % fts)
+                except sqlite3.OperationalError:
+                    continue
+                self.fts = fts
+                break
+            else:
+                db.close()
+                return False
+            db.commit()
+        except (sqlite3.Error, OSError):
+            return False
+        self.db = db
+        return True
+
+    def add(self, pages):
+        "add found pages (dicts with site, page, title and hash)"
+        self.ilock.acquire()
+        try:
+            if self.connect():
+                self.db_add(pages)
+            else:
+                for i in pages:
+                    rec = self.records.get(i["hash"])
+                    info = "" if rec is None else rec[3]
+                    self.mem_put(i["hash"], [i["site"], i["page"],
+                                             i["title"].strip(), info])
+        finally:
+            self.ilock.release()
+
+    def set_info(self, site, page, info):
+        "store info text of the page which is in the index already"
+        text = info_text(info)
+        if not text:
+            return
+        phash = page_hash(site, page)
+        self.ilock.acquire()
+        try:
+            if self.connect():
+                self.db_info(phash, text)
+            elif phash in self.records:
+                self.mem_put(phash, self.records[phash][:3] + [text])
+        finally:
+            self.ilock.release()
+
+    def search(self, what, where=None, limit=LIMIT):
+        """Returns pages which title or info contains all the words of
+        what (as prefixes). where is the set of sites to look in."""
+        words = _WORD.findall(what.lower())
+        if not words:
+            return []
+        self.ilock.acquire()
+        try:
+            if self.connect():
+                found = self.db_search(words)
+            else:
+                found = self.mem_search(words)
+        finally:
+            self.ilock.release()
+        res = []
+        for phash, site, page, title in found:
+            if where is None or site in where:
+                res.append({"site": site, "page": page, "title": title,
+                            "hash": phash})
+                if len(res) >= limit:
+                    break
+        return res
+
+    def db_add(self, pages):
+        db = self.db
+        try:
+            for i in pages:
+                title = i["title"].strip()
+                row = db.execute("SELECT id, title FROM pages WHERE hash=?",
+                                 (i["hash"],)).fetchone()
+                if row is None:
+                    cur = db.execute(
+                        "INSERT INTO pages (hash, site, page, title) "
+                        "VALUES (?, ?, ?, ?)",
+                        (i["hash"], i["site"], i["page"], title))
+                    db.execute("INSERT INTO ptext (rowid, title, info) "
+                               "VALUES (?, ?, '')", (cur.lastrowid, title))
+                elif row[1] != title:
+                    db.execute("UPDATE pages SET title=? WHERE id=?",
+                               (title, row[0]))
+                    db.execute("UPDATE ptext SET title=? WHERE rowid=?",
+                               (title, row[0]))
+            db.commit()
+        except sqlite3.Error:
+            db.rollback()
+
+    def db_info(self, phash, text):
+        db = self.db
+        try:
+            row = db.execute("SELECT id FROM pages WHERE hash=?",
+                             (phash,)).fetchone()
+            if row is not None:
+                db.execute("UPDATE ptext SET info=? WHERE rowid=?",
+                           (text, row[0]))
+                db.commit()
+        except sqlite3.Error:
+            db.rollback()
+
+    def db_search(self, words):
+        # words are \w+, so they need no escaping; FTS4 does not accept
+        # the prefix mark after a quoted string
+        if self.fts == "fts5":
+            query = " ".join('"%s"*' % i for i in words)
+        else:
+            query = " ".join("%s*" % i for i in words)
+        try:
+            return self.db.execute(
+                "SELECT p.hash, p.site, p.page, p.title FROM ptext "
+                "JOIN pages p ON p.id = ptext.rowid WHERE ptext MATCH ? "
+                "ORDER BY p.id DESC", (query,)).fetchall()
+        except sqlite3.Error:
+            return []
+
+    def mem_put(self, phash, rec):
+        old = self.records.get(phash)
+        if old is not None:
+            for word in set(_WORD.findall(" ".join(old[2:]).lower())):
+                self.words[word].discard(phash)
+        self.records[phash] = rec
+        for word in set(_WORD.findall(" ".join(rec[2:]).lower())):
+            self.words.setdefault(word, set()).add(phash)
+
+    def mem_search(self, words):
+        found = None
+        for word in words:
+            hashes = set()
+            for key, phashes in self.words.items():
+                if key.startswith(word):
+                    hashes |= phashes
+            found = hashes if found is None else found & hashes
+            if not found:
+                return []
+        return [(h,) + tuple(self.records[h][:3]) for h in found]
+
+    def clear(self):
+        self.ilock.acquire()
+        try:
+            if self.connect():
+                try:
+                    self.db.execute("DELETE FROM ptext")
+                    self.db.execute("DELETE FROM pages")
+                    self.db.commit()
+                except sqlite3.Error:
+                    self.db.rollback()
+            self.records.clear()
+            self.words.clear()
+        finally:
+            self.ilock.release()
+
+
+INDEX = TextIndex()
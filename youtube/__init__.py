@@ -15,17 +15,17 @@
 YouTube data treatment
 """
 
-from urllib.request import urlopen, Request
 from urllib.parse import urlencode
 from .parser import SearchParser, parse_dpage
 from hashlib import md5
+from pool import urlopen
 
 
 def web_search(what):
     o = urlopen("https://youtube.com/results?%s" %
                 urlencode([("search_query", what)]))
     sp = SearchParser(o.read().decode())
-    del o
+    o.close()
     if sp.found:
         for i in sp.found:
             md5o = md5("/".join((i["site"], i["page"])).encode("utf8"))
@@ -34,8 +34,6 @@ def web_search(what):
     return []
 
 
-def get_datapage(page):
-    r = Request("https://youtube.com" + page)
-    o = urlopen(r)
+def get_datapage(page, found=None):
     files, info = parse_dpage("https://youtube.com" + page)
-    return files, info
+    return files, info, "Files"
@@ -16,14 +16,18 @@ YouTube data parser
 """
 from html.parser import HTMLParser
 from sys import hexversion
-from os import popen
+from subprocess import check_output
+from threading import Lock
+from time import time
+from urllib.parse import urlsplit, parse_qs
+import json
 
 
 class SearchParser(HTMLParser):
     "parses  html file"
     def __init__(self, data):
         di = {}
-        if hexversion >= 0x030200f0:
+        if 0x030200f0 <= hexversion < 0x030500f0:
             di["strict"] = False
         HTMLParser.__init__(self, **di)
         self.found = []
@@ -43,10 +47,50 @@ class SearchParser(HTMLParser):
             self.found.append(curdata)
 
 
+META_TTL = 3600.
+# youtube-dl is killed after so many seconds, TimeoutExpired is raised
+META_TIMEOUT = 60.
+_META = {}
+_MLOCK = Lock()
+
+
+def video_id(url):
+    return parse_qs(urlsplit(url).query).get("v", [url])[0]
+
+
+def url_expiry(furl):
+    "signed media URLs carry their expiration time in the expire parameter"
+    try:
+        return float(parse_qs(urlsplit(furl).query)["expire"][0]) - 60.
+    except (KeyError, IndexError, ValueError):
+        return time() + META_TTL
+
+
+def get_meta(url):
+    """Returns youtube-dl metadata of the video. It is cached by video id
+    until the media URL expires."""
+    vid = video_id(url)
+    now = time()
+    _MLOCK.acquire()
+    entry = _META.get(vid)
+    _MLOCK.release()
+    if entry is not None and entry[0] > now:
+        return entry[1]
+    meta = json.loads(check_output(
+        ["youtube-dl", "-j", "-f", "5", url],
+        timeout=META_TIMEOUT).decode("utf8"))
+    _MLOCK.acquire()
+    for i in [k for k, v in _META.items() if v[0] <= now]:
+        del _META[i]
+    _META[vid] = (url_expiry(meta.get("url", "")), meta)
+    _MLOCK.release()
+    return meta
+
+
 def parse_dpage(url):
-    furl = popen("youtube-dl -gf5 '%s'" % url, "r").read()
-    title = popen("youtube-dl --get-title '%s'" % url, "r").read()
+    meta = get_meta(url)
+    title = meta.get("title", "")
     fname = title.translate({34: 95, 47: 95}).strip() + '.flv'
-    res = [(furl, fname)]
-    info = [(popen("youtube-dl --get-description '%s'" % url, "r").read(), ())]
+    res = [(meta["url"], fname)]
+    info = [(meta.get("description", ""), ())]
     return res, info